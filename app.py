@@ -7,7 +7,19 @@ from io import BytesIO
 import json
 import re
 import requests
+from concurrent.futures import wait
 from bs4 import BeautifulSoup
+from scheduler import ModelCallScheduler
+from turn_cache import TurnSnapshotCache
+from routing import RoutingPolicy, price
+from session_store import PendingAttachment, SearchMemo, SessionMessages, attachments
+from deadline import DeadlineExceeded, turn_deadline, current_deadline, time_budget
+from metrics import MetricsReporter, latency
+from token_budget import CHARS_PER_TOKEN, count_tokens, content_tokens, estimator as cost_estimator
+import time
+import math
+import logging
+from typing import Optional
 from database import (
     add_message,
     get_messages,
@@ -24,8 +36,11 @@ from database import (
     get_ancient_history,
     get_recent_ah,
     add_ancient_history_entry,
+    mark_ah_rolled_up,
+    ah_turn_bounds,
     search_extended_history,
     get_all_notes,
+    get_note,
     set_note,
     clear_note,
     export_all_data,
@@ -130,12 +145,109 @@ def set_background(image_file, opacity=0.420):
     </style>
     """, unsafe_allow_html=True)
 set_background("link_photo.png")
-# Opus pricing per token (dollars/tokens)
-INPUT_COST_PER_TOKEN = 5.00 / 1_000_000
-OUTPUT_COST_PER_TOKEN = 25.00 / 1_000_000
-
 # Initialize client
-client = Anthropic(api_key=st.secrets["ANTHROPIC_API_KEY"])
+client = Anthropic(api_key=st.secrets["ANTHROPIC_API_KEY"], max_retries=1)
+
+# Time budgets (seconds). Every DB, HTTP and model call in a turn shares TURN_DEADLINE.
+TURN_DEADLINE = 300
+MODEL_TIMEOUT = 240
+URL_FETCH_TIMEOUT = 6
+# Kept back from the model call so the reply can still be saved
+PERSIST_RESERVE = 15
+
+# Shared across sessions: caps in-flight model calls and coalesces duplicate turns
+@st.cache_resource
+def get_model_scheduler() -> ModelCallScheduler:
+    return ModelCallScheduler(max_concurrent=int(st.secrets.get("MAX_CONCURRENT_MODEL_CALLS", 4)))
+
+model_scheduler = get_model_scheduler()
+
+# Latency per DB, HTTP and model operation plus gauges (session-state bytes, ...), logged periodically for this worker
+@st.cache_resource
+def get_metrics_reporter() -> MetricsReporter:
+    return MetricsReporter(interval=float(st.secrets.get("METRICS_LOG_INTERVAL", 60)))
+
+get_metrics_reporter()
+
+@st.cache_resource
+def get_turn_snapshots() -> TurnSnapshotCache:
+    return TurnSnapshotCache()
+
+turn_snapshots = get_turn_snapshots()
+
+# Extra attempts with the same assembled request before giving up on a turn
+TURN_RETRIES = 1
+
+# Ancient history in the prompt is kept under this many (estimated) tokens by
+# merging the oldest AH_ROLLUP_FANOUT entries of a level into one digest
+AH_TOKEN_BUDGET = 2500
+AH_ROLLUP_FANOUT = 6
+AH_ROLLUP_MAX_MERGES = 3
+
+logger = logging.getLogger(__name__)
+
+def scheduled_model_call(user_id: str, key: str, status=None, on_response=None, **request):
+    """Run a messages.create call through the scheduler. Returns (response, owner).
+
+    `owner` is True for exactly one caller per key — only that caller should persist the result.
+    `on_response(response)` runs inside the job as soon as the call returns, so
+    usage is logged even if no caller is left waiting to claim it.
+    """
+    # The call runs on a scheduler thread, so carry the caller's deadline over explicitly
+    deadline = current_deadline()
+
+    def run():
+        timeout = MODEL_TIMEOUT
+        if deadline is not None:
+            timeout = min(timeout, deadline.remaining() - PERSIST_RESERVE)
+            if timeout <= 0:
+                raise DeadlineExceeded("turn deadline passed while queued")
+        # Under a deadline the timeout is all the time left, so an SDK retry would overrun it
+        call_client = client.with_options(max_retries=0) if deadline is not None else client
+        start = time.monotonic()
+        try:
+            response = call_client.messages.create(timeout=timeout, **request)
+        except Exception:
+            latency.record(f"model.{request['model']}", time.monotonic() - start, error=True)
+            raise
+        latency.record(f"model.{request['model']}", time.monotonic() - start)
+        if on_response is not None:
+            try:
+                on_response(response)
+            except Exception:
+                logger.exception("on_response hook failed for %s", key)
+        return response
+
+    ticket = model_scheduler.submit(user_id, key, run)
+    while not ticket.future.done():
+        if deadline is not None and deadline.remaining() <= 0:
+            raise DeadlineExceeded("turn deadline exceeded waiting for the model")
+        if status is not None:
+            ahead = model_scheduler.position(ticket)
+            if ahead:
+                status.caption(f"Lots of chats right now — {ahead} ahead of you 🐾")
+            else:
+                status.empty()
+        wait([ticket.future], timeout=0.5)
+    if status is not None:
+        status.empty()
+    response = ticket.future.result()
+    return response, model_scheduler.claim(ticket)
+
+def log_model_usage(user_id: str, call_type: str, route_name: str, response, estimated_input_tokens: Optional[int] = None):
+    model = routing_policy.routes[route_name]["model"]
+    u = response.usage
+    cache_write = getattr(u, "cache_creation_input_tokens", 0) or 0
+    cache_read = getattr(u, "cache_read_input_tokens", 0) or 0
+    in_cost, out_cost = price(model, u.input_tokens, u.output_tokens, cache_write, cache_read)
+    log_token_usage(user_id, call_type, u.input_tokens + cache_write + cache_read, u.output_tokens, in_cost, out_cost, in_cost + out_cost, model=model, route=route_name, estimated_input_tokens=estimated_input_tokens)
+
+def cached_system(text: str) -> list:
+    """System prompt as a cache breakpoint, so memory calls on the same model reuse the prefix."""
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+# Model/thinking-budget routes — override with the MODEL_ROUTES secret (JSON)
+routing_policy = RoutingPolicy(json.loads(st.secrets.get("MODEL_ROUTES", "{}")))
 
 # Access codes — add friends here as: "their_code": "their_name"
 ACCESS_CODES = json.loads(st.secrets["ACCESS_CODES"])
@@ -175,7 +287,10 @@ def load_system_prompt():
     return st.secrets["KOEDY_PROMPT"]
 
 def build_full_system_prompt():
+    """Returns (prompt, token estimate). AH, summaries and notes are counted from their
+    stored token_count; only the fixed prompt and the framing around them are measured here."""
     base_prompt = load_system_prompt()
+    stored_tokens, stored_chars = 0, 0
 
     # Add ancient history
     ah_entries = get_ancient_history(user_id)
@@ -183,6 +298,8 @@ def build_full_system_prompt():
         ah_section = "\n\n=== Ancient Conversation History ===\n"
         for entry in ah_entries:
             ah_section += f"\n{entry['turn_range']}:\n{entry['content']}\n"
+            stored_chars += len(entry["content"])
+        stored_tokens += ah_tokens(ah_entries)
         base_prompt += ah_section
 
     # Add recent summaries
@@ -191,6 +308,8 @@ def build_full_system_prompt():
         summary_section = "\n\n=== EXTENDED CONVERSATION HISTORY ===\n"
         for s in summaries:
             summary_section += f"\nTurns {s['turn_start']}-{s['turn_end']} Summary:\n{s['summary_text']}\n"
+            stored_tokens += s.get("token_count") or count_tokens(s["summary_text"])
+            stored_chars += len(s["summary_text"])
         base_prompt += summary_section
 
     # Add notes
@@ -210,6 +329,10 @@ def build_full_system_prompt():
 
     if has_notes:
         base_prompt += notes_section
+        for note in notes.values():
+            if note and note["content"]:
+                stored_tokens += note.get("token_count") or count_tokens(note["content"])
+                stored_chars += len(note["content"])
 
     base_prompt += """
 
@@ -228,7 +351,8 @@ You also have permission find information as you see fit from past conversations
 [SEARCH: your query] - This enables you to search extended history. Results appear in your next context. Pairs well with notes — note what to SEARCH for when topics recur.
 """
 
-    return base_prompt
+    framing_tokens = math.ceil((len(base_prompt) - stored_chars) / CHARS_PER_TOKEN)
+    return base_prompt, framing_tokens + stored_tokens
 
 def format_messages_for_api(messages: list, current_turn: int) -> list:
     """Format messages with temporal context so Koedy can track time and turns."""
@@ -248,11 +372,7 @@ def format_messages_for_api(messages: list, current_turn: int) -> list:
             formatted.append({"role": "assistant", "content": prefix + msg["content"]})
     return formatted
 
-def generate_summary(user_id: str, messages_to_summarize: list, turn_start: int, turn_end: int) -> str:
-    """Generate a summary of messages using a hidden API call."""
-    base_prompt = load_system_prompt()
-
-    summary_prompt = f"""Summarize this conversation segment (Turns {turn_start}-{turn_end}). Begin with the turn range and context tags [personal, technical, creative, emotional, casual, etc.].
+SUMMARY_INSTRUCTIONS = """Summarize this conversation segment (Turns {turn_start}-{turn_end}). Begin with the turn range and context tags [personal, technical, creative, emotional, casual, etc.].
 
 This summary exists so Koedy can know and serve this user better over time. Prioritize user calibration above all else.
 
@@ -268,6 +388,19 @@ Do not overlap with previous summaries — add new calibration context only.
 Weight who the user IS over what they asked about. No markdown.
 Target 125 words. Hard limit 175."""
 
+COMPRESSION_INSTRUCTIONS = """Compress the following conversation summary into an ancient history entry for long-term user context.
+
+Preserve only: calibration data (who the user is, how they communicate, what matters to them), significant relationship developments, ongoing thread updates, emotional patterns observed.
+Distill to essential facts. No markdown. One dense paragraph.
+Do not overlap with previous AH entries provided below.
+Target 60 words; Hard limit 80."""
+
+def generate_summary(user_id: str, messages_to_summarize: list, turn_start: int, turn_end: int) -> str:
+    """Generate a summary of messages using a hidden API call."""
+    base_prompt = load_system_prompt()
+
+    summary_prompt = SUMMARY_INSTRUCTIONS.format(turn_start=turn_start, turn_end=turn_end)
+
     # Fetch previous summaries for context threading
     prev_summaries = get_recent_summaries(user_id, limit=2)
 
@@ -286,44 +419,29 @@ Target 125 words. Hard limit 175."""
 
     content += "\n\n" + summary_prompt
 
-    response = client.messages.create(
-        model="claude-sonnet-4-5",
-        max_tokens=5000,
-        system=base_prompt,
-        thinking={
-            "type": "enabled",
-            "budget_tokens": 3500
-        },
+    response, _ = scheduled_model_call(
+        user_id,
+        f"summary:{user_id}:{turn_start}-{turn_end}",
+        on_response=lambda r: log_model_usage(user_id, "summary", "summary", r),
+        **routing_policy.request_kwargs("summary"),
+        system=cached_system(base_prompt),
         messages=[{
             "role": "user",
             "content": content
         }]
     )
 
-    usage = response.usage
-    in_tokens = usage.input_tokens
-    out_tokens = usage.output_tokens
-    in_cost = in_tokens * INPUT_COST_PER_TOKEN
-    out_cost = out_tokens * OUTPUT_COST_PER_TOKEN
-    log_token_usage(user_id, "summary", in_tokens, out_tokens, in_cost, out_cost, in_cost + out_cost)
-
     for block in response.content:
         if block.type == "text":
             return block.text
     return ""
 
-def compress_summary_to_ah(summary: dict) -> str:
+def compress_summary_to_ah(user_id: str, summary: dict) -> str:
     """Compress a summary into ancient history."""
- 
-    compression_prompt = """Compress the following conversation summary into an ancient history entry for long-term user context.
-
-Preserve only: calibration data (who the user is, how they communicate, what matters to them), significant relationship developments, ongoing thread updates, emotional patterns observed.
-Distill to essential facts. No markdown. One dense paragraph.
-Do not overlap with previous AH entries provided below.
-Target 60 words; Hard limit 80."""
+    base_prompt = load_system_prompt()
 
     # Fetch previous AH entries for overlap prevention
-    prev_ah = get_recent_ah(limit=4)
+    prev_ah = get_recent_ah(user_id, limit=4)
 
     content = ""
     if prev_ah:
@@ -333,34 +451,165 @@ Target 60 words; Hard limit 80."""
         content += "---\n\n"
 
     content += f"Summary to compress (Turns {summary['turn_start']}-{summary['turn_end']}):\n{summary['summary_text']}\n\n"
-    content += compression_prompt
-
-    response = client.messages.create(
-        model="claude-sonnet-4-5",
-        max_tokens=5000,
-        system=base_prompt,
-        thinking={
-            "type": "enabled",
-            "budget_tokens": 3000
-        },
+    content += COMPRESSION_INSTRUCTIONS
+
+    response, _ = scheduled_model_call(
+        user_id,
+        f"compression:{user_id}:{summary['id']}",
+        on_response=lambda r: log_model_usage(user_id, "compression", "compression", r),
+        **routing_policy.request_kwargs("compression"),
+        system=cached_system(base_prompt),
         messages=[{
             "role": "user",
             "content": content
         }]
     )
 
-    usage = response.usage
-    in_tokens = usage.input_tokens
-    out_tokens = usage.output_tokens
-    in_cost = in_tokens * INPUT_COST_PER_TOKEN
-    out_cost = out_tokens * OUTPUT_COST_PER_TOKEN
-    log_token_usage(user_id, "compression", in_tokens, out_tokens, in_cost, out_cost, in_cost + out_cost)
-
     for block in response.content:
         if block.type == "text":
             return block.text
     return ""
 
+def generate_memory_update(user_id: str, messages_to_summarize: list, turn_start: int, turn_end: int, due: list):
+    """New summary plus AH compressions for the `due` summaries, in one model call.
+
+    Returns (summary_text, {summary_id: ah_text}), or None if the reply has no
+    usable summary. Compressions missing from the reply are left to the caller.
+    """
+    base_prompt = load_system_prompt()
+    prev_summaries = get_recent_summaries(user_id, limit=2)
+    prev_ah = get_recent_ah(user_id, limit=4)
+
+    content = ""
+    if prev_summaries:
+        content += "Previous summaries for context continuity (do not repeat — use to connect threads and reduce overlap):\n\n"
+        for s in prev_summaries:
+            content += f"Turns {s['turn_start']}-{s['turn_end']}: {s['summary_text']}\n\n"
+        content += "---\n\n"
+    if prev_ah:
+        content += "Previous AH entries (do not overlap with these):\n\n"
+        for entry in prev_ah:
+            content += f"{entry['turn_range']}: {entry['content']}\n\n"
+        content += "---\n\n"
+
+    content += "New conversation segment to summarize:\n\n"
+    for msg in messages_to_summarize:
+        role = "User" if msg["role"] == "user" else "Koedy"
+        content += f"{role}: {msg['content']}\n\n"
+    content += "---\n\n"
+
+    for s in due:
+        content += f'Summary to compress, id {s["id"]} (Turns {s["turn_start"]}-{s["turn_end"]}):\n{s["summary_text"]}\n\n'
+
+    content += f"""---
+
+Do two jobs and reply with only the tagged sections below.
+
+1. {SUMMARY_INSTRUCTIONS.format(turn_start=turn_start, turn_end=turn_end)}
+
+2. For each summary to compress above: {COMPRESSION_INSTRUCTIONS}
+
+<summary>the new summary</summary>
+""" + "".join(f'<ah_entry id="{s["id"]}">the compressed entry for summary {s["id"]}</ah_entry>\n' for s in due)
+
+    response, _ = scheduled_model_call(
+        user_id,
+        f"memory:{user_id}:{turn_start}-{turn_end}",
+        on_response=lambda r: log_model_usage(user_id, "memory_update", "memory_update", r),
+        **routing_policy.request_kwargs("memory_update"),
+        system=cached_system(base_prompt),
+        messages=[{
+            "role": "user",
+            "content": content
+        }]
+    )
+
+    text = "".join(block.text for block in response.content if block.type == "text")
+    summary_match = re.search(r"<summary>\s*([\s\S]*?)\s*</summary>", text)
+    if not summary_match or not summary_match.group(1):
+        logger.warning("memory update for %s had no <summary>; falling back to separate calls", user_id)
+        return None
+    due_ids = {s["id"] for s in due}
+    compressed = {}
+    for ah_id, ah_text in re.findall(r'<ah_entry id="(\d+)">\s*([\s\S]*?)\s*</ah_entry>', text):
+        if int(ah_id) in due_ids and ah_text:
+            compressed[int(ah_id)] = ah_text
+    return summary_match.group(1), compressed
+
+def ah_tokens(entries: list) -> int:
+    # token_count is stored at write time (migrations/0005_token_counts.sql)
+    return sum(e.get("token_count") or count_tokens(e["content"]) for e in entries)
+
+def pick_ah_rollup(entries: list):
+    """Oldest run of AH_ROLLUP_FANOUT entries on the lowest level that has that many, else the oldest few."""
+    by_level = {}
+    for entry in entries:
+        by_level.setdefault(entry.get("level") or 0, []).append(entry)
+    for level in sorted(by_level):
+        if len(by_level[level]) >= AH_ROLLUP_FANOUT:
+            return level + 1, by_level[level][:AH_ROLLUP_FANOUT]
+    if len(entries) >= 2:
+        group = entries[:min(AH_ROLLUP_FANOUT, len(entries))]
+        return max(e.get("level") or 0 for e in group) + 1, group
+    return None
+
+def rollup_ancient_history(user_id: str):
+    """Merge old AH entries into epoch digests until the user's AH fits AH_TOKEN_BUDGET.
+
+    Runs as a scheduler job (off the chat turn), so it calls the client directly.
+    """
+    base_prompt = load_system_prompt()
+    for _ in range(AH_ROLLUP_MAX_MERGES):
+        entries = get_ancient_history(user_id)
+        if ah_tokens(entries) <= AH_TOKEN_BUDGET:
+            return
+        picked = pick_ah_rollup(entries)
+        if not picked:
+            return
+        level, group = picked
+        turn_range = f"Turns {ah_turn_bounds(group[0])[0]}-{ah_turn_bounds(group[-1])[1]}"
+
+        content = "Ancient history entries to merge, oldest first:\n\n"
+        for entry in group:
+            content += f"{entry['turn_range']}: {entry['content']}\n\n"
+        content += f"""---
+
+Merge these entries into one epoch digest for {turn_range}, for long-term user context.
+Keep what still calibrates Koedy to this user: who they are, how they communicate, what matters to them, lasting relationship developments and patterns. Drop resolved threads and anything superseded by a later entry.
+No markdown. One dense paragraph.
+Target 120 words; Hard limit 160."""
+
+        route = "compression"
+        response = client.messages.create(
+            timeout=MODEL_TIMEOUT,
+            **routing_policy.request_kwargs(route),
+            system=cached_system(base_prompt),
+            messages=[{"role": "user", "content": content}]
+        )
+        log_model_usage(user_id, "compression", route, response)
+
+        digest = next((block.text for block in response.content if block.type == "text"), "")
+        if not digest:
+            return
+        add_ancient_history_entry(user_id, turn_range, digest, level=level)
+        mark_ah_rolled_up(user_id, [e["id"] for e in group])
+
+def schedule_ah_rollup(user_id: str):
+    """Queue a background rollup if this user's AH is over budget. Doesn't wait for it."""
+    entries = get_ancient_history(user_id)
+    if ah_tokens(entries) <= AH_TOKEN_BUDGET:
+        return
+
+    def job():
+        try:
+            rollup_ancient_history(user_id)
+        except Exception:
+            logger.exception("AH rollup failed for %s", user_id)
+
+    # Own scheduler lane so it never holds up the user's chat turns; the key
+    # dedupes reruns while a rollup over the same entries is queued or running
+    model_scheduler.submit(f"maintenance:{user_id}", f"ah-rollup:{user_id}:{entries[0]['id']}:{len(entries)}", job)
+
 def check_and_summarize(user_id: str):
     """Check if we need to summarize and do it."""
     count = get_message_count(user_id)
@@ -374,8 +623,16 @@ def check_and_summarize(user_id: str):
             turn_start = total_summarized + 1
             turn_end = total_summarized + 25
 
-            # Generate summary with turn range context
-            summary_text = generate_summary(user_id, oldest_messages, turn_start, turn_end)
+            # Live summaries beyond the newest two get compressed to AH once this one lands
+            live = get_recent_summaries(user_id, limit=100)
+            due = live[:max(0, len(live) - 1)]
+
+            # One call for the summary and every compression due; separate calls if it can't be parsed
+            update = generate_memory_update(user_id, oldest_messages, turn_start, turn_end, due) if due else None
+            if update:
+                summary_text, compressed = update
+            else:
+                summary_text, compressed = generate_summary(user_id, oldest_messages, turn_start, turn_end), {}
 
             # Save summary
             summary_id = add_summary(user_id, turn_start, turn_end, summary_text)
@@ -384,21 +641,20 @@ def check_and_summarize(user_id: str):
             summary_entry = {
                 "role": "system",
                 "content": f"[SUMMARY of turns {turn_start}-{turn_end}]\n{summary_text}",
-                "thinking": None,
                 "timestamp": datetime.now(PT).strftime("%A %Y-%m-%d %H:%M:%S")
             }
             archive_messages(user_id, oldest_messages + [summary_entry], summary_id)
 
             # Delete from active messages
             ids_to_delete = [msg["id"] for msg in oldest_messages]
-            delete_messages_by_ids(ids_to_delete)
+            delete_messages_by_ids(ids_to_delete, drop_thinking=False)
 
             # Check if summaries need compression to AH
             non_archived_count = get_non_archived_summary_count(user_id)
             while non_archived_count > 2:
                 oldest = get_oldest_non_archived_summary(user_id)
                 if oldest:
-                    ah_content = compress_summary_to_ah(user_id, oldest)
+                    ah_content = compressed.pop(oldest["id"], None) or compress_summary_to_ah(user_id, oldest)
                     turn_range = f"Turns {oldest['turn_start']}-{oldest['turn_end']}"
                     add_ancient_history_entry(user_id, turn_range, ah_content)
                     mark_summary_archived(oldest['id'])
@@ -406,50 +662,63 @@ def check_and_summarize(user_id: str):
                 else:
                     break
 
+            schedule_ah_rollup(user_id)
             return True
     return False
 
-def process_note_tags(response_text: str) -> str:
+def process_note_tags(response_text: str):
+    """Strip note tags from the reply. Returns the clean text and the note writes to apply."""
     import re
 
+    note_updates = []
+
     active_match = re.search(r'\[ACTIVE NOTE:\s*([\s\S]*?)\]', response_text)
     if active_match:
         content = active_match.group(1).strip()
         if len(content) <= 2500:
-            set_note(user_id, "active", content)
+            note_updates.append(("active", content))
         response_text = response_text.replace(active_match.group(0), "").strip()
 
     ongoing_match = re.search(r'\[ONGOING NOTE:\s*([\s\S]*?)\]', response_text)
     if ongoing_match:
         content = ongoing_match.group(1).strip()
         if len(content) <= 5000:
-            set_note(user_id, "ongoing", content)
+            note_updates.append(("ongoing", content))
         response_text = response_text.replace(ongoing_match.group(0), "").strip()
 
     permanent_match = re.search(r'\[PERMANENT NOTE:\s*([\s\S]*?)\]', response_text)
     if permanent_match:
         content = permanent_match.group(1).strip()
         if len(content) <= 10000:
-            existing = get_all_notes(user_id)["permanent"]
-            if existing and existing["content"]:
-                content = existing["content"] + "\n\n---\n\n" + content
-            set_note(user_id, "permanent", content)
+            note_updates.append(("permanent", content))
         response_text = response_text.replace(permanent_match.group(0), "").strip()
 
-    return response_text
+    return response_text, note_updates
+
+def save_note_updates(note_updates: list):
+    for note_type, content in note_updates:
+        if note_type == "permanent":
+            # Straight from the DB, not the cache: appending to a stale copy would drop entries
+            existing = get_note(user_id, "permanent")
+            if existing and existing["content"]:
+                content = existing["content"] + "\n\n---\n\n" + content
+        set_note(user_id, note_type, content)
 
 def extract_urls(text):
     return re.findall(r'https?://[^\s<>"{}|\\^`\[\]]+', text)
 
 def fetch_page_text(url, char_limit=5000):
+    start = time.monotonic()
     try:
-        resp = requests.get(url, timeout=10, headers={"User-Agent": "Mozilla/5.0"})
+        resp = requests.get(url, timeout=time_budget(URL_FETCH_TIMEOUT), headers={"User-Agent": "Mozilla/5.0"})
         resp.raise_for_status()
+        latency.record("http.fetch_page", time.monotonic() - start)
         soup = BeautifulSoup(resp.text, "html.parser")
         for tag in soup(["script", "style", "nav", "footer", "header"]):
             tag.decompose()
         return soup.get_text(separator="\n", strip=True)[:char_limit]
     except Exception:
+        latency.record("http.fetch_page", time.monotonic() - start, error=True)
         return None
 
 def enrich_message_with_urls(text):
@@ -463,26 +732,30 @@ def enrich_message_with_urls(text):
             enriched += f"\n\n[Content from {url}]:\n{page_text}"
     return enriched
 
-def call_koedy(user_id, context_depth, is_resend=False):
-    """Make API call and handle response. Extracted so resend can reuse it."""
-    # Check spending limit
-    usage_data = get_user_total_usage(user_id)
-    spending_limit = get_spending_limit(user_id)
-    if usage_data["total_cost"] >= spending_limit:
-        with st.chat_message("assistant", avatar="logo.png"):
-            st.write("You've reached your current message limit! Reach out to Koyote to continue. 🐾")
-        return
+def make_turn_key(user_id, message_id):
+    return f"turn:{user_id}:{message_id}"
 
+def assemble_turn_request(user_id, context_depth):
+    """Build everything the model call for this turn needs: summarize, prompt, history, URLs, attachment."""
     # Summarize if needed
     with st.spinner("Getting to know you better..."):
         summarized = check_and_summarize(user_id)
     if summarized:
         st.toast("✨ Memory updated")
+        # Archived turns are now searchable
+        st.session_state.search_results = SearchMemo(SEARCH_MEMO_SIZE)
 
-    full_system_prompt = build_full_system_prompt()
+    full_system_prompt, system_tokens = build_full_system_prompt()
     db_messages = get_messages(user_id, limit=context_depth * 2)
     api_messages = format_messages_for_api(db_messages, get_turn_counter(user_id))
+    # Keyed on the user message being answered, so a double-clicked resend or a
+    # rerun mid-call joins the call already in flight instead of paying twice
+    turn_key = make_turn_key(user_id, db_messages[-1]["id"] if db_messages else 0)
+    attachment_key = None
     
+    # Route on the raw user text (without its turn/timestamp prefix)
+    raw_text = db_messages[-1]["content"] if db_messages and db_messages[-1]["role"] == "user" else ""
+
     # Enrich last message with any URL content
     if api_messages and api_messages[-1]["role"] == "user":
         api_messages[-1]["content"] = enrich_message_with_urls(api_messages[-1]["content"])
@@ -490,32 +763,168 @@ def call_koedy(user_id, context_depth, is_resend=False):
     # Handle pending file attachment
     attachment = st.session_state.get("pending_attachment")
     if attachment and api_messages and api_messages[-1]["role"] == "user":
+        attachment_key = attachment["file_key"]
         if attachment["type"] == "image":
-            text_content = api_messages[-1]["content"]
-            api_messages[-1]["content"] = [
-                {"type": "image", "source": {
-                    "type": "base64",
-                    "media_type": attachment["media_type"],
-                    "data": attachment["base64"]
-                }},
-                {"type": "text", "text": text_content}
-            ]
+            # Session state only holds a reference; the bytes live in the shared store
+            image_bytes = attachments.get(attachment["ref"])
+            if image_bytes is None:
+                st.caption(f"⚠️ {attachment['filename']} expired — attach it again")
+                # Nothing was sent, so route as plain text and let the same file be attached again
+                attachment_key = None
+            else:
+                text_content = api_messages[-1]["content"]
+                api_messages[-1]["content"] = [
+                    {"type": "image", "source": {
+                        "type": "base64",
+                        "media_type": attachment["media_type"],
+                        "data": base64.b64encode(image_bytes).decode()
+                    }},
+                    {"type": "text", "text": text_content}
+                ]
         elif attachment["type"] == "pdf":
             api_messages[-1]["content"] += f"\n\n[Content from {attachment['filename']}]:\n{attachment['text']}"
 
-        st.session_state.last_sent_file = attachment["file_key"]
+        if attachment_key is not None:
+            st.session_state.last_sent_file = attachment_key
         st.session_state.pop("pending_attachment", None)
-    
+
+    route_name = routing_policy.route_chat(raw_text, has_attachment=attachment_key is not None, url_count=len(extract_urls(raw_text)))
+
+    # Per-message estimates from the stored counts, plus the turn/timestamp prefix;
+    # the last message is re-measured since URL content or an attachment may have been added
+    message_tokens = []
+    for m, api in zip(db_messages, api_messages[:-1]):
+        prefix = api["content"][:len(api["content"]) - len(m["content"])]
+        message_tokens.append((m.get("token_count") or count_tokens(m["content"])) + count_tokens(prefix))
+    if api_messages:
+        message_tokens.append(content_tokens(api_messages[-1]["content"]))
+
+    return {
+        "turn_key": turn_key,
+        "route": route_name,
+        "context_depth": context_depth,
+        "system": full_system_prompt,
+        "messages": api_messages,
+        "system_tokens": system_tokens,
+        "message_tokens": message_tokens,
+        "attachment_key": attachment_key
+    }
+
+def fit_turn_to_budget(snapshot: dict, budget: float):
+    """Drop the oldest context messages until the estimated cost fits `budget`.
+
+    Returns (messages, estimated raw input tokens), or (None, tokens) if even the
+    latest message alone doesn't fit.
+    """
+    route = routing_policy.routes[snapshot["route"]]
+    messages, tokens = snapshot["messages"], snapshot["message_tokens"]
+    drop = 0
+    while True:
+        raw_tokens = snapshot["system_tokens"] + sum(tokens[drop:])
+        if cost_estimator.cost(route["model"], snapshot["route"], raw_tokens, route["max_tokens"]) <= budget:
+            return messages[drop:], raw_tokens
+        if drop >= len(messages) - 1:
+            return None, raw_tokens
+        # The request has to start on a user message
+        drop += 1
+        while drop < len(messages) - 1 and messages[drop]["role"] != "user":
+            drop += 1
+
+def call_koedy(user_id, context_depth, is_resend=False):
+    """Make API call and handle response. Extracted so resend can reuse it."""
+    with turn_deadline(TURN_DEADLINE):
+        failed = run_turn(user_id, context_depth, is_resend)
+
+    # Cleanup runs outside the deadline so it still happens after a timeout
+    if failed:
+        turn_snapshots.invalidate(user_id)
+        if not is_resend and st.session_state.display_messages and st.session_state.display_messages[-1].role == "user":
+            st.session_state.display_messages.pop()
+            recent = get_messages(user_id, limit=1)
+            if recent and recent[0]["role"] == "user":
+                delete_messages_by_ids([recent[0]["id"]])
+
+def prepare_turn(user_id, context_depth, is_resend):
+    """Spending check, request assembly (including any rollover) and pre-flight trim.
+
+    Returns (snapshot, messages, raw_input_tokens), or None if the turn is blocked by the limit.
+    """
+    # Check spending limit
+    usage_data = get_user_total_usage(user_id)
+    spending_limit = get_spending_limit(user_id)
+    if usage_data["total_cost"] >= spending_limit:
+        with st.chat_message("assistant", avatar="logo.png"):
+            st.write("You've reached your current message limit! Reach out to Koyote to continue. 🐾")
+        return None
+
+    # Resend reuses the request assembled for this turn — nothing in it has changed
+    snapshot = None
+    if is_resend:
+        # Only if it was built for the message being answered now — a later turn
+        # that failed before storing its own snapshot leaves the previous one behind
+        recent = get_messages(user_id, limit=1)
+        current_key = make_turn_key(user_id, recent[0]["id"] if recent else 0)
+        snapshot = turn_snapshots.latest(user_id, context_depth, turn_key=current_key)
+    if snapshot is None:
+        snapshot = assemble_turn_request(user_id, context_depth)
+        turn_snapshots.put(user_id, snapshot)
+
+    # Pre-flight: price the request locally and trim old context to fit what's left of the limit
+    messages, raw_input_tokens = fit_turn_to_budget(snapshot, spending_limit - usage_data["total_cost"])
+    if messages is None:
+        with st.chat_message("assistant", avatar="logo.png"):
+            st.write("That one would take you past your current message limit — try something shorter, or reach out to Koyote to continue. 🐾")
+        return None
+    if len(messages) < len(snapshot["messages"]):
+        st.caption("Running low on budget — Koedy is using a shorter memory of this chat 🐾")
+    return snapshot, messages, raw_input_tokens
+
+def run_turn(user_id, context_depth, is_resend) -> bool:
+    """One turn under the current deadline. Returns True if it failed and needs cleanup."""
+    # DB reads and summary calls here share the deadline, so they fail the same way the reply call does
+    try:
+        prepared = prepare_turn(user_id, context_depth, is_resend)
+    except DeadlineExceeded:
+        with st.chat_message("assistant", avatar="logo.png"):
+            st.warning("Koedy took too long to answer — try sending your message again. 🐾")
+        return True
+    except Exception:
+        logger.exception("turn preparation failed for %s", user_id)
+        with st.chat_message("assistant", avatar="logo.png"):
+            st.warning("Something went wrong — try sending your message again. 🐾")
+        return True
+    if prepared is None:
+        return False
+    snapshot, messages, raw_input_tokens = prepared
+
+    def log_turn_usage(response):
+        # Runs in the scheduler job: billed calls are logged even if this rerun is gone
+        model = routing_policy.routes[snapshot["route"]]["model"]
+        accuracy = cost_estimator.observe(model, snapshot["route"], raw_input_tokens, response.usage)
+        logger.info("input estimate %d vs actual %d tokens (%+.1f%%)", accuracy["estimated_input_tokens"], accuracy["actual_input_tokens"], accuracy["error"] * 100)
+        log_model_usage(user_id, "message", snapshot["route"], response, estimated_input_tokens=accuracy["estimated_input_tokens"])
+
     with st.chat_message("assistant", avatar="logo.png"):
         try:
+            queue_status = st.empty()
             with st.spinner("Koedy is ruminating..."):
-                response = client.messages.create(
-                    model="claude-opus-4-6",
-                    max_tokens=16000,
-                    thinking={"type": "enabled", "budget_tokens": 10000},
-                    system=full_system_prompt,
-                    messages=api_messages
-                )
+                for attempt in range(TURN_RETRIES + 1):
+                    try:
+                        response, owner = scheduled_model_call(
+                            user_id,
+                            snapshot["turn_key"],
+                            status=queue_status,
+                            on_response=log_turn_usage,
+                            **routing_policy.request_kwargs(snapshot["route"]),
+                            system=snapshot["system"],
+                            messages=messages
+                        )
+                        break
+                    except DeadlineExceeded:
+                        raise
+                    except Exception:
+                        if attempt == TURN_RETRIES:
+                            raise
 
             response_timestamp = datetime.now(PT).strftime("%H:%M:%S %Y-%m-%d")
 
@@ -527,31 +936,27 @@ def call_koedy(user_id, context_depth, is_resend=False):
                 elif block.type == "text":
                     response_text = block.text
 
-            u = response.usage
-            in_cost = u.input_tokens * INPUT_COST_PER_TOKEN
-            out_cost = u.output_tokens * OUTPUT_COST_PER_TOKEN
-            log_token_usage(user_id, "message", u.input_tokens, u.output_tokens, in_cost, out_cost, in_cost + out_cost)
-
-            clean_response = process_note_tags(response_text)
-            add_message(user_id, "assistant", clean_response, thinking_text, response_timestamp)
-
-            st.session_state.display_messages.append({
-                "role": "assistant",
-                "content": clean_response,
-                "thinking": thinking_text,
-                "timestamp": response_timestamp
-            })
+            clean_response, note_updates = process_note_tags(response_text)
 
+            # Render first — the remaining writes don't change what the user sees
             st.write(clean_response)
             st.markdown(f'<p style="text-align: right; font-size: 0.75em; color: #385480;">{response_timestamp}</p>', unsafe_allow_html=True)
 
+            # A duplicate of this turn already stored the reply; just show it
+            if owner:
+                save_note_updates(note_updates)
+                add_message(user_id, "assistant", clean_response, thinking_text, response_timestamp)
+
+            st.session_state.display_messages.append("assistant", clean_response, response_timestamp)
+
+        except DeadlineExceeded:
+            st.warning("Koedy took too long to answer — try sending your message again. 🐾")
+            return True
         except Exception:
             st.warning("Something went wrong — try sending your message again. 🐾")
-            if not is_resend and st.session_state.display_messages and st.session_state.display_messages[-1]["role"] == "user":
-                st.session_state.display_messages.pop()
-                recent = get_messages(user_id, limit=1)
-                if recent and recent[0]["role"] == "user":
-                    delete_messages_by_ids([recent[0]["id"]])
+            return True
+
+    return False
 
 # === STREAMLIT UI ===
 
@@ -559,7 +964,89 @@ st.title("Koedy")
 
 # Initialize display messages
 if "display_messages" not in st.session_state:
-    st.session_state.display_messages = get_messages(user_id)
+    st.session_state.display_messages = SessionMessages(get_messages(user_id))
+if "turn_counter" not in st.session_state:
+    st.session_state.turn_counter = get_turn_counter(user_id)
+
+# Search results per query for this session, so reruns don't repeat the DB search
+SEARCH_MEMO_SIZE = 20
+
+# Sidebar panels below rerun on their own (st.fragment): typing a search,
+# attaching a file or exporting doesn't re-execute the rest of the script.
+
+@st.fragment
+def attachment_panel(user_id: str):
+    st.caption("Attach file:")
+    uploaded_file = st.file_uploader(
+        "Upload",
+        type=["png", "jpg", "jpeg", "gif", "webp", "pdf"],
+        label_visibility="collapsed"
+    )
+    if uploaded_file:
+        file_key = f"{uploaded_file.name}_{uploaded_file.size}"
+        if file_key != st.session_state.get("last_sent_file"):
+            file_bytes = uploaded_file.read()
+            file_type = uploaded_file.type
+
+            if file_type == "application/pdf":
+                try:
+                    with pdfplumber.open(BytesIO(file_bytes)) as pdf:
+                        text = "\n".join(page.extract_text() or "" for page in pdf.pages)
+                    st.session_state.pending_attachment = PendingAttachment(
+                        type="pdf",
+                        text=text[:10000],
+                        filename=uploaded_file.name,
+                        file_key=file_key
+                    )
+                    st.caption(f"📎 {uploaded_file.name} ready")
+                except Exception:
+                    st.caption("⚠️ Couldn't read PDF")
+            else:
+                ref = f"{user_id}:{file_key}"
+                attachments.put(ref, file_bytes)
+                st.session_state.pending_attachment = PendingAttachment(
+                    type="image",
+                    ref=ref,
+                    media_type=file_type,
+                    filename=uploaded_file.name,
+                    file_key=file_key
+                )
+                st.caption(f"📎 {uploaded_file.name} ready")
+        else:
+            st.caption(f"📎 {uploaded_file.name} sent ✓")
+
+    st.caption("Koedy only sees files while attached", help="Remove file(s) when you're done — adds cost each turn attached")
+
+@st.fragment
+def search_panel(user_id: str):
+    st.caption("Search history:")
+    search_query = st.text_input("Search", label_visibility="collapsed", placeholder="Search past conversations...")
+    if search_query:
+        memo = st.session_state.setdefault("search_results", SearchMemo(SEARCH_MEMO_SIZE))
+        results = memo.get(search_query)
+        if results is None:
+            results = search_extended_history(user_id, search_query)
+            memo.put(search_query, results)
+        if results:
+            for r in results:
+                role = "You" if r["role"] == "user" else "Koedy"
+                preview = r["content"][:200].replace("\n", " ")
+                st.markdown(f"**{role}:** {preview}...")
+        else:
+            st.caption("Nothing found — try different terms 🐾")
+
+@st.fragment
+def export_panel(user_id: str):
+    st.header("Export")
+    if st.button("Export Data"):
+        data = export_all_data(user_id)
+        st.download_button(
+            label="Download JSON",
+            data=json.dumps(data, indent=2),
+            file_name=f"koedy_export_{datetime.now(PT).strftime('%Y%m%d_%H%M%S')}.json",
+            mime="application/json",
+            on_click="ignore"
+        )
 
 # Sidebar
 with st.sidebar:
@@ -579,7 +1066,7 @@ with st.sidebar:
     st.divider()
 
     turn_display = st.empty()
-    turn_display.write(f"Turn: {get_turn_counter(user_id)}")
+    turn_display.write(f"Turn: {st.session_state.turn_counter}")
 
     st.divider()
 
@@ -587,7 +1074,7 @@ with st.sidebar:
     col1, col2 = st.columns(2)
     with col1:
         if st.button("↻ Resend", use_container_width=True):
-            if st.session_state.display_messages and st.session_state.display_messages[-1]["role"] == "assistant":
+            if st.session_state.display_messages and st.session_state.display_messages[-1].role == "assistant":
                 st.session_state.display_messages.pop()
                 recent = get_messages(user_id, limit=1)
                 if recent and recent[0]["role"] == "assistant":
@@ -602,89 +1089,36 @@ with st.sidebar:
                 for _ in range(min(2, len(st.session_state.display_messages))):
                     if st.session_state.display_messages:
                         st.session_state.display_messages.pop()
-                decrement_turn_counter(user_id)
+                st.session_state.turn_counter = decrement_turn_counter(user_id)
+            turn_snapshots.invalidate(user_id)
             st.rerun()
 
     st.divider()
 
-    st.caption("Attach file:")
-    uploaded_file = st.file_uploader(
-        "Upload",
-        type=["png", "jpg", "jpeg", "gif", "webp", "pdf"],
-        label_visibility="collapsed"
-    )
-    if uploaded_file:
-        file_key = f"{uploaded_file.name}_{uploaded_file.size}"
-        if file_key != st.session_state.get("last_sent_file"):
-            file_bytes = uploaded_file.read()
-            file_type = uploaded_file.type
-
-            if file_type == "application/pdf":
-                try:
-                    with pdfplumber.open(BytesIO(file_bytes)) as pdf:
-                        text = "\n".join(page.extract_text() or "" for page in pdf.pages)
-                    st.session_state.pending_attachment = {
-                        "type": "pdf",
-                        "text": text[:10000],
-                        "filename": uploaded_file.name,
-                        "file_key": file_key
-                    }
-                    st.caption(f"📎 {uploaded_file.name} ready")
-                except Exception:
-                    st.caption("⚠️ Couldn't read PDF")
-            else:
-                b64 = base64.b64encode(file_bytes).decode()
-                st.session_state.pending_attachment = {
-                    "type": "image",
-                    "base64": b64,
-                    "media_type": file_type,
-                    "filename": uploaded_file.name,
-                    "file_key": file_key
-                }
-                st.caption(f"📎 {uploaded_file.name} ready")
-        else:
-            st.caption(f"📎 {uploaded_file.name} sent ✓")
-
-    st.caption("Koedy only sees files while attached", help="Remove file(s) when you're done — adds cost each turn attached")
+    attachment_panel(user_id)
 
     st.divider()
 
-    st.caption("Search history:")
-    search_query = st.text_input("Search", label_visibility="collapsed", placeholder="Search past conversations...")
-    if search_query:
-        results = search_extended_history(user_id, search_query)
-        if results:
-            for r in results:
-                role = "You" if r["role"] == "user" else "Koedy"
-                preview = r["content"][:200].replace("\n", " ")
-                st.markdown(f"**{role}:** {preview}...")
-        else:
-            st.caption("Nothing found — try different terms 🐾")
-        
+    search_panel(user_id)
+
     st.divider()
 
-    st.header("Export")
-    if st.button("Export Data"):
-        data = export_all_data(user_id)
-        st.download_button(
-            label="Download JSON",
-            data=json.dumps(data, indent=2),
-            file_name=f"koedy_export_{datetime.now(PT).strftime('%Y%m%d_%H%M%S')}.json",
-            mime="application/json"
-        )
+    export_panel(user_id)
 
 # Display conversation
+if st.session_state.display_messages.dropped:
+    st.caption("Older messages are tucked away — search your history to find them 🐾")
 for msg in st.session_state.display_messages:
-    if msg["role"] == "user":
+    if msg.role == "user":
         with st.chat_message("user", avatar="chat_logo.png"):
-            st.write(msg["content"])
-            if msg.get("timestamp"):
-                st.markdown(f'<p style="text-align: right; font-size: 0.75em; color: #385480;">{msg["timestamp"]}</p>', unsafe_allow_html=True)
+            st.write(msg.content)
+            if msg.timestamp:
+                st.markdown(f'<p style="text-align: right; font-size: 0.75em; color: #385480;">{msg.timestamp}</p>', unsafe_allow_html=True)
     else:
         with st.chat_message("assistant", avatar="logo.png"):
-            st.write(msg["content"])
-            if msg.get("timestamp"):
-                st.markdown(f'<p style="text-align: right; font-size: 0.75em; color: #385480;">{msg["timestamp"]}</p>', unsafe_allow_html=True)
+            st.write(msg.content)
+            if msg.timestamp:
+                st.markdown(f'<p style="text-align: right; font-size: 0.75em; color: #385480;">{msg.timestamp}</p>', unsafe_allow_html=True)
 
 # Action buttons are in sidebar
 
@@ -694,22 +1128,19 @@ if st.session_state.get("needs_resend"):
     call_koedy(user_id, context_depth, is_resend=True)
     st.rerun()
 # Chat input
-user_messages = [m for m in st.session_state.display_messages if m["role"] == "user"]
+user_messages = [m for m in st.session_state.display_messages if m.role == "user"]
 
 if st.session_state.get("user_id") == "Anthropic" and len(user_messages) >= 10:
     st.chat_input("I bet you wanted to send an 11th 😏", disabled=True)
 elif user_input := st.chat_input("Hey there! Name's Koedy. What's on your mind?"):
     turn_number = increment_turn_counter(user_id)
+    st.session_state.turn_counter = turn_number
     user_timestamp = datetime.now(PT).strftime("%A %H:%M:%S %Y-%m-%d")
     turn_display.write(f"Turn: {turn_number}")
 
     add_message(user_id, "user", user_input, None, user_timestamp)
 
-    st.session_state.display_messages.append({
-        "role": "user",
-        "content": user_input,
-        "timestamp": user_timestamp
-    })
+    st.session_state.display_messages.append("user", user_input, user_timestamp)
 
     with st.chat_message("user", avatar="chat_logo.png"):
         st.write(user_input)
@@ -0,0 +1,160 @@
+"""Cold tier for extended history: immutable, gzipped NDJSON segments per user.
+
+Layout under the store root:
+
+    <user dir>/index.json                           segment list + high-water id
+    <user dir>/seg-<first id>-<last id>.ndjson.gz   one archived row per line, by id
+
+Segments are never modified once written. Every row in a segment has an id at
+or below the index's high-water mark, and rows above it are still in the hot
+table, so the two tiers never overlap.
+"""
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+INDEX_NAME = "index.json"
+
+
+def _fsync_dir(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_durably(path: Path, data: bytes):
+    """Write to a temp file, fsync, then rename into place, so readers see all of it or none."""
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(path.parent)
+
+
+class ColdStore:
+    def __init__(self, root: str, cached_segments: int = 16):
+        self.root = Path(root)
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._cache_size = cached_segments
+
+    def _user_dir(self, user_id: str) -> Path:
+        # Readable prefix plus a hash, so arbitrary user ids can't collide or escape the root
+        safe = re.sub(r"[^A-Za-z0-9_-]", "_", user_id)[:40]
+        return self.root / f"{safe}-{hashlib.sha1(user_id.encode('utf-8')).hexdigest()[:10]}"
+
+    def index(self, user_id: str) -> Dict[str, Any]:
+        path = self._user_dir(user_id) / INDEX_NAME
+        if not path.exists():
+            return {"high_water": 0, "segments": []}
+        return json.loads(path.read_text())
+
+    def high_water(self, user_id: str) -> int:
+        """Highest extended history id already in the cold tier (0 if none)."""
+        return self.index(user_id)["high_water"]
+
+    def write_segment(self, user_id: str, rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Persist rows (ascending ids, all above the high-water mark) as a new segment.
+
+        Returns once the segment and the updated index are both fsynced; only
+        then is it safe to delete the rows from the hot table.
+        """
+        if not rows:
+            raise ValueError("empty segment")
+        with self._lock:
+            index = self.index(user_id)
+            ids = [row["id"] for row in rows]
+            if ids != sorted(ids) or ids[0] <= index["high_water"]:
+                raise ValueError(f"segment ids must ascend past the high-water mark {index['high_water']}")
+
+            user_dir = self._user_dir(user_id)
+            user_dir.mkdir(parents=True, exist_ok=True)
+            payload = gzip.compress(
+                b"".join(json.dumps(row, separators=(",", ":")).encode("utf-8") + b"\n" for row in rows),
+                compresslevel=9
+            )
+            name = f"seg-{ids[0]}-{ids[-1]}.ndjson.gz"
+            _write_durably(user_dir / name, payload)
+
+            message_ids = [row["message_id"] for row in rows if row.get("message_id") is not None]
+            segment = {
+                "file": name,
+                "first_id": ids[0],
+                "last_id": ids[-1],
+                "min_message_id": min(message_ids) if message_ids else None,
+                "max_message_id": max(message_ids) if message_ids else None,
+                "first_timestamp": rows[0].get("timestamp"),
+                "last_timestamp": rows[-1].get("timestamp"),
+                "rows": len(rows),
+                "bytes": len(payload),
+                "sha256": hashlib.sha256(payload).hexdigest()
+            }
+            index["segments"].append(segment)
+            index["high_water"] = ids[-1]
+            _write_durably(user_dir / INDEX_NAME, json.dumps(index, indent=1).encode("utf-8"))
+            return segment
+
+    def _segment_rows(self, user_id: str, segment: Dict[str, Any]) -> List[Dict[str, Any]]:
+        path = self._user_dir(user_id) / segment["file"]
+        key = str(path)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hashlib.sha256(mm).hexdigest() != segment["sha256"]:
+                raise IOError(f"cold segment {path} is corrupt (checksum mismatch)")
+            rows = [json.loads(line) for line in gzip.decompress(mm).splitlines() if line]
+
+        with self._lock:
+            self._cache[key] = rows
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return rows
+
+    def iter_rows(self, user_id: str, newest_first: bool = False) -> Iterator[Dict[str, Any]]:
+        """Archived rows in id order. Each is a copy, so callers may edit it without touching the cache."""
+        segments = self.index(user_id)["segments"]
+        for segment in (reversed(segments) if newest_first else segments):
+            rows = self._segment_rows(user_id, segment)
+            for row in (reversed(rows) if newest_first else rows):
+                yield dict(row)
+
+    def search(self, user_id: str, query: str, limit: int = 20, thinking_of: Optional[Callable[[Dict[str, Any]], str]] = None) -> List[Dict[str, Any]]:
+        """Case-insensitive substring match, newest first (same semantics as the hot ilike).
+
+        Matches content, and the row's thinking too when `thinking_of` decodes it.
+        """
+        needle = query.lower()
+        matches = []
+        for row in self.iter_rows(user_id, newest_first=True):
+            if needle in row["content"].lower() or (thinking_of is not None and needle in thinking_of(row).lower()):
+                matches.append(row)
+                if len(matches) >= limit:
+                    break
+        return matches
+
+    def find(self, user_id: str, message_id: Optional[int] = None, extended_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """One archived row by original message id or extended history id, using the index ranges."""
+        for segment in self.index(user_id)["segments"]:
+            if extended_id is not None and segment["first_id"] <= extended_id <= segment["last_id"]:
+                row = next((r for r in self._segment_rows(user_id, segment) if r["id"] == extended_id), None)
+                return dict(row) if row else None
+            if message_id is not None and segment["min_message_id"] is not None \
+                    and segment["min_message_id"] <= message_id <= segment["max_message_id"]:
+                row = next((r for r in self._segment_rows(user_id, segment) if r.get("message_id") == message_id), None)
+                if row:
+                    return dict(row)
+        return None
@@ -1,284 +1,629 @@
+import base64
+import logging
+import re
+import threading
+import time
+import zlib
 import streamlit as st
-from datetime import datetime
-from typing import Optional, List, Dict, Any
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeout
+from datetime import date, datetime, timezone
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Tuple
 from supabase import create_client, Client
+from supabase.lib.client_options import ClientOptions
+from write_queue import WriteBehindQueue
+from shared_cache import SharedCache, make_backend
+from cold_storage import ColdStore
+from deadline import DeadlineExceeded, current_deadline, time_budget, backoff
+from metrics import latency
+from token_budget import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Hard ceiling for any single PostgREST request, deadline or not
+DB_CLIENT_TIMEOUT = 15
+DB_READ_TIMEOUT = 5.0
+DB_WRITE_TIMEOUT = 8.0
+DB_READ_ATTEMPTS = 3
 
 @st.cache_resource
 def get_supabase() -> Client:
     return create_client(
         st.secrets["SUPABASE_URL"],
-        st.secrets["SUPABASE_KEY"]
+        st.secrets["SUPABASE_KEY"],
+        options=ClientOptions(postgrest_client_timeout=DB_CLIENT_TIMEOUT)
     )
 
 def db() -> Client:
     return get_supabase()
 
+# === Deadline-Bounded Execution ===
+# Queries run on a small pool so a stalled request can be abandoned when the
+# turn deadline (see deadline.turn_deadline) runs out, instead of hanging the rerun.
+
+# A turn has at most one read and its hedge in flight at a time
+DB_WORKERS_PER_SESSION = 2
+
+class DbPool:
+    """Thread pool that knows how many of its workers are free and when each task starts."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="koedy-db")
+        self._lock = threading.Lock()
+        self._outstanding = 0
+
+    def submit(self, fn) -> Tuple[Future, threading.Event]:
+        started = threading.Event()
+        def run():
+            started.set()
+            return fn()
+        with self._lock:
+            self._outstanding += 1
+        future = self._pool.submit(run)
+        future.add_done_callback(self._task_done)
+        return future, started
+
+    def _task_done(self, _future):
+        with self._lock:
+            self._outstanding -= 1
+
+    def idle(self) -> int:
+        with self._lock:
+            return self.workers - self._outstanding
+
+@st.cache_resource
+def get_db_pool() -> DbPool:
+    sessions = int(st.secrets.get("EXPECTED_CONCURRENT_SESSIONS", 8))
+    return DbPool(max(4, sessions * DB_WORKERS_PER_SESSION))
+
+def _hedge_delay(op: str) -> float:
+    # Fire a backup request once this one is slower than ~p95 for the op
+    p95 = latency.percentile(f"db.{op}", 95) if latency.count(f"db.{op}") >= 20 else None
+    return max(0.25, p95) if p95 else 1.0
+
+def _hedged_execute(query, op: str, timeout: float):
+    """Run `query`, with a backup attempt if it's slow. `timeout` counts from when it
+    starts on a worker (time queued for one isn't the DB being slow), capped by the turn deadline."""
+    pool = get_db_pool()
+    first, started = pool.submit(query.execute)
+    if not started.wait(timeout):
+        first.cancel()
+        raise DeadlineExceeded(f"{op} waited {timeout:.1f}s for a DB worker")
+    start = time.monotonic()
+    expires_at = start + timeout
+    deadline = current_deadline()
+    if deadline is not None:
+        expires_at = min(expires_at, deadline.expires_at)
+
+    futures = [first]
+    done, _ = wait(futures, timeout=max(0.0, min(expires_at, start + _hedge_delay(op)) - time.monotonic()))
+    # No spare worker means the pool is saturated; a hedge would only queue behind more work
+    if not done and pool.idle() > 0:
+        futures.append(pool.submit(query.execute)[0])
+    while True:
+        remaining = expires_at - time.monotonic()
+        done, pending = wait(futures, timeout=max(0.0, remaining), return_when=FIRST_COMPLETED)
+        if not done:
+            for fut in pending:
+                fut.cancel()
+            raise DeadlineExceeded(f"{op} timed out after {timeout:.1f}s")
+        for fut in done:
+            if fut.exception() is None:
+                return fut.result()
+        if not pending:
+            raise next(iter(done)).exception()
+        futures = list(pending)
+
+def _read(query, op: str):
+    """Idempotent read: deadline-bounded, hedged, retried with jittered backoff."""
+    for attempt in range(DB_READ_ATTEMPTS):
+        timeout = time_budget(DB_READ_TIMEOUT)
+        start = time.monotonic()
+        try:
+            result = _hedged_execute(query, op, timeout)
+            latency.record(f"db.{op}", time.monotonic() - start)
+            return result
+        except Exception:
+            latency.record(f"db.{op}", time.monotonic() - start, error=True)
+            if attempt == DB_READ_ATTEMPTS - 1:
+                raise
+            time.sleep(backoff(attempt))
+
+def _write(query, op: str):
+    """Non-idempotent write: one attempt, fails fast once the deadline is gone."""
+    timeout = time_budget(DB_WRITE_TIMEOUT)
+    start = time.monotonic()
+    try:
+        future, _ = get_db_pool().submit(query.execute)
+        result = future.result(timeout=timeout)
+    except FutureTimeout:
+        # Unless it never got a worker, the write may still land; callers must not blindly retry it
+        future.cancel()
+        latency.record(f"db.{op}", time.monotonic() - start, error=True)
+        raise DeadlineExceeded(f"{op} timed out after {timeout:.1f}s")
+    except Exception:
+        latency.record(f"db.{op}", time.monotonic() - start, error=True)
+        raise
+    latency.record(f"db.{op}", time.monotonic() - start)
+    return result
+
+# === Write-Behind Queue ===
+# Usage logs don't need to land before the reply renders,
+# so they are batched and bulk-inserted from a background thread.
+
+def _bulk_insert(table: str, rows: List[Dict[str, Any]]):
+    # Background thread: no turn deadline, and never abandoned mid-insert (the queue retries)
+    db().table(table).insert(rows).execute()
+
+def _after_flush(table: str, rows: List[Dict[str, Any]]):
+    # Usage totals only change in the DB once the batch lands
+    if table == "koedy_token_usage":
+        get_shared_cache().invalidate(*{f"usage:{r['user_id']}" for r in rows})
+
+@st.cache_resource
+def get_write_queue() -> WriteBehindQueue:
+    return WriteBehindQueue(_bulk_insert, on_flush=_after_flush)
+
+# === Shared Cache ===
+# Per-user context (AH, summaries, notes, counters, usage) shared by every worker.
+# Backed by Redis when REDIS_URL is set, otherwise in-process. Every write below
+# invalidates the keys it affects, which is broadcast to all workers.
+#
+# Deploying more than one worker (or host) needs two shared things: REDIS_URL,
+# so invalidations reach every worker, and COLD_STORAGE_DIR on a volume every
+# worker mounts (see Cold Storage below). A worker that can't see the cold tier
+# silently leaves tiered rows out of search and export.
+
+@st.cache_resource
+def get_shared_cache() -> SharedCache:
+    return SharedCache(make_backend(st.secrets.get("REDIS_URL")))
+
+def cached(key: str, loader, ttl: Optional[float] = None):
+    return get_shared_cache().get_or_load(key, loader, ttl)
+
+def invalidate(*keys: str):
+    get_shared_cache().invalidate(*keys)
+
+# === Cold Storage ===
+# Extended history older than the tiering threshold lives in immutable segment
+# files (cold_storage.py, moved there by tier_history.py), and nowhere else once
+# tiered. COLD_STORAGE_DIR must be on a persistent volume shared by every worker;
+# tier_history.py refuses to run without it set explicitly.
+
+@st.cache_resource
+def get_cold_store() -> ColdStore:
+    root = st.secrets.get("COLD_STORAGE_DIR")
+    if root and not Path(root).is_dir():
+        logger.warning("COLD_STORAGE_DIR %s is not mounted here; tiered history will be missing from search and export", root)
+    return ColdStore(root or "cold_storage")
+
 # === Message Functions ===
+# Thinking text lives in koedy_thinking (compressed at rest by Postgres), not
+# inline, so the hot-path selects below never pull it. Use get_thinking / include_thinking to load it.
+
+MESSAGE_COLUMNS = "id, role, content, timestamp, token_count"
+
+def _row_to_message(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "role": row["role"],
+        "content": row["content"],
+        "timestamp": row["timestamp"],
+        "token_count": row.get("token_count")
+    }
 
 def add_message(user_id: str, role: str, content: str, thinking: Optional[str], timestamp: str) -> int:
-    result = db().table("koedy_messages").insert({
+    result = _write(db().table("koedy_messages").insert({
         "user_id": user_id,
         "role": role,
         "content": content,
-        "thinking": thinking,
-        "timestamp": timestamp
-    }).execute()
-    return result.data[0]["id"] if result.data else 0
-
-def get_messages(user_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
-    query = db().table("koedy_messages").select("*").eq("user_id", user_id).order("id", desc=False)
+        "timestamp": timestamp,
+        "token_count": count_tokens(content)
+    }), "add_message")
+    msg_id = result.data[0]["id"] if result.data else 0
+    if thinking and msg_id:
+        # Synchronous so a Resend/Delete right after can't race a queued insert and orphan it.
+        # The reply is already stored and shown; losing its thinking mustn't fail the turn.
+        try:
+            _write(db().table("koedy_thinking").insert({
+                "user_id": user_id,
+                "message_id": msg_id,
+                "extended_id": None,
+                "thinking_text": thinking
+            }), "add_message.thinking")
+        except Exception:
+            logger.exception("thinking for message %s not stored", msg_id)
+    return msg_id
+
+def get_messages(user_id: str, limit: Optional[int] = None, include_thinking: bool = False) -> List[Dict[str, Any]]:
+    query = db().table("koedy_messages").select(MESSAGE_COLUMNS).eq("user_id", user_id).order("id", desc=False)
 
     if limit:
-        count_result = db().table("koedy_messages").select("id", count="exact").eq("user_id", user_id).execute()
+        count_result = _read(db().table("koedy_messages").select("id", count="exact").eq("user_id", user_id), "get_messages")
         total = count_result.count or 0
 
         if total > limit:
-            query = db().table("koedy_messages").select("*").eq("user_id", user_id).order("id", desc=True).limit(limit)
-            result = query.execute()
-            return list(reversed([{
-                "id": row["id"],
-                "role": row["role"],
-                "content": row["content"],
-                "thinking": row["thinking"],
-                "timestamp": row["timestamp"]
-            } for row in result.data])) if result.data else []
-
-    result = query.execute()
-    return [{
-        "id": row["id"],
-        "role": row["role"],
-        "content": row["content"],
-        "thinking": row["thinking"],
-        "timestamp": row["timestamp"]
-    } for row in result.data] if result.data else []
+            query = db().table("koedy_messages").select(MESSAGE_COLUMNS).eq("user_id", user_id).order("id", desc=True).limit(limit)
+            result = _read(query, "get_messages")
+            messages = list(reversed([_row_to_message(row) for row in result.data])) if result.data else []
+            return _attach_thinking(user_id, messages) if include_thinking else messages
+
+    result = _read(query, "get_messages")
+    messages = [_row_to_message(row) for row in result.data] if result.data else []
+    return _attach_thinking(user_id, messages) if include_thinking else messages
 
 def get_message_count(user_id: str) -> int:
-    result = db().table("koedy_messages").select("id", count="exact").eq("user_id", user_id).execute()
+    result = _read(db().table("koedy_messages").select("id", count="exact").eq("user_id", user_id), "get_message_count")
     return result.count or 0
 
 def get_oldest_messages(user_id: str, count: int) -> List[Dict[str, Any]]:
-    result = db().table("koedy_messages").select("*").eq("user_id", user_id).order("id", desc=False).limit(count).execute()
-    return [{
-        "id": row["id"],
-        "role": row["role"],
-        "content": row["content"],
-        "thinking": row["thinking"],
-        "timestamp": row["timestamp"]
-    } for row in result.data] if result.data else []
-
-def delete_messages_by_ids(ids: List[int]):
-    for msg_id in ids:
-        db().table("koedy_messages").delete().eq("id", msg_id).execute()
+    result = _read(db().table("koedy_messages").select(MESSAGE_COLUMNS).eq("user_id", user_id).order("id", desc=False).limit(count), "get_oldest_messages")
+    return [_row_to_message(row) for row in result.data] if result.data else []
+
+def delete_messages_by_ids(ids: List[int], drop_thinking: bool = True):
+    if ids:
+        _write(db().table("koedy_messages").delete().in_("id", ids), "delete_messages_by_ids")
+    # Archived messages keep their thinking — extended history still points at it
+    if drop_thinking and ids:
+        _write(db().table("koedy_thinking").delete().in_("message_id", ids), "delete_messages_by_ids")
+
+# === Thinking Functions ===
+
+def decompress_thinking(blob: str) -> str:
+    # base64(zlib) form from before migrations/0009; cold segments written then still carry it
+    return zlib.decompress(base64.b64decode(blob)).decode("utf-8")
+
+def get_thinking(user_id: str, message_id: Optional[int] = None, extended_id: Optional[int] = None) -> Optional[str]:
+    """Load one thinking block, by original message id or (for pre-migration archives) extended history id."""
+    query = db().table("koedy_thinking").select("thinking_text").eq("user_id", user_id)
+    if message_id is not None:
+        query = query.eq("message_id", message_id)
+    elif extended_id is not None:
+        query = query.eq("extended_id", extended_id)
+    else:
+        return None
+    result = _read(query.limit(1), "get_thinking")
+    if result.data:
+        return result.data[0]["thinking_text"]
+    # Tiered rows carry their thinking with them
+    row = get_cold_store().find(user_id, message_id=message_id, extended_id=extended_id)
+    return (_cold_thinking(row) or None) if row else None
+
+def _attach_thinking(user_id: str, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    ids = [m["id"] for m in messages]
+    thinking = {}
+    if ids:
+        result = _read(db().table("koedy_thinking").select("message_id, thinking_text").eq("user_id", user_id).in_("message_id", ids), "_attach_thinking")
+        thinking = {row["message_id"]: row["thinking_text"] for row in result.data or []}
+    for m in messages:
+        m["thinking"] = thinking.get(m["id"])
+    return messages
 
 # === Summary Functions ===
 
 def add_summary(user_id: str, turn_start: int, turn_end: int, summary_text: str) -> int:
-    result = db().table("koedy_summaries").insert({
+    result = _write(db().table("koedy_summaries").insert({
         "user_id": user_id,
         "turn_start": turn_start,
         "turn_end": turn_end,
-        "summary_text": summary_text
-    }).execute()
+        "summary_text": summary_text,
+        "token_count": count_tokens(summary_text)
+    }), "add_summary")
+    invalidate(f"summaries:{user_id}")
     return result.data[0]["id"] if result.data else 0
 
-def get_recent_summaries(user_id: str, limit: int = 2) -> List[Dict[str, Any]]:
-    result = db().table("koedy_summaries").select("*").eq("user_id", user_id).eq("archived", False).order("id", desc=True).limit(limit).execute()
-    if not result.data:
-        return []
-    rows = list(reversed(result.data))
+def _load_live_summaries(user_id: str) -> List[Dict[str, Any]]:
+    # Compression keeps only a couple of summaries un-archived, so cache them all
+    result = _read(db().table("koedy_summaries").select("*").eq("user_id", user_id).eq("archived", False).order("id"), "_load_live_summaries")
     return [{
         "id": row["id"],
         "turn_start": row["turn_start"],
         "turn_end": row["turn_end"],
         "summary_text": row["summary_text"],
+        "token_count": row.get("token_count"),
         "created_at": row["created_at"]
-    } for row in rows]
+    } for row in result.data or []]
+
+def get_recent_summaries(user_id: str, limit: int = 2) -> List[Dict[str, Any]]:
+    rows = cached(f"summaries:{user_id}", lambda: _load_live_summaries(user_id))
+    return rows[-limit:] if limit else []
 
 def get_total_turns_summarized(user_id: str) -> int:
-    result = db().table("koedy_summaries").select("turn_end").eq("user_id", user_id).order("id", desc=True).limit(1).execute()
+    result = _read(db().table("koedy_summaries").select("turn_end").eq("user_id", user_id).order("id", desc=True).limit(1), "get_total_turns_summarized")
     if result.data:
         return result.data[0]["turn_end"]
     return 0
 
 def get_non_archived_summary_count(user_id: str) -> int:
-    result = db().table("koedy_summaries").select("id").eq("user_id", user_id).eq("archived", False).execute()
+    result = _read(db().table("koedy_summaries").select("id").eq("user_id", user_id).eq("archived", False), "get_non_archived_summary_count")
     return len(result.data) if result.data else 0
 
 def get_oldest_non_archived_summary(user_id: str):
-    result = db().table("koedy_summaries").select("*").eq("user_id", user_id).eq("archived", False).order("id").limit(1).execute()
+    result = _read(db().table("koedy_summaries").select("*").eq("user_id", user_id).eq("archived", False).order("id").limit(1), "get_oldest_non_archived_summary")
     return result.data[0] if result.data else None
 
 def mark_summary_archived(summary_id: int):
-    db().table("koedy_summaries").update({"archived": True}).eq("id", summary_id).execute()
+    result = _write(db().table("koedy_summaries").update({"archived": True}).eq("id", summary_id), "mark_summary_archived")
+    if result.data:
+        invalidate(f"summaries:{result.data[0]['user_id']}")
 
 # === Ancient History Functions ===
 
-def get_ancient_history(user_id: str) -> List[Dict[str, Any]]:
-    result = db().table("koedy_ancient_history").select("*").eq("user_id", user_id).order("id").execute()
-    return result.data if result.data else []
-    
-def get_recent_ah(limit: int = 4) -> List[Dict[str, Any]]:
-    """Get the most recent ancient history entries for overlap prevention."""
-    result = db().table("ancient_history").select("*").order("id", desc=True).limit(limit).execute()
+# Entries are level 0 (one compressed summary) or level N > 0 (an epoch digest
+# merging several level N-1 entries). Merged entries are flagged rolled_up and
+# drop out of the prompt but stay in the table for export.
 
-    if not result.data:
-        return []
+def ah_turn_bounds(entry: Dict[str, Any]) -> tuple:
+    nums = [int(n) for n in re.findall(r"\d+", entry.get("turn_range") or "")]
+    return (nums[0], nums[-1]) if nums else (0, 0)
+
+def get_ancient_history(user_id: str, include_rolled_up: bool = False) -> List[Dict[str, Any]]:
+    """Live AH entries in chronological (turn) order; digests sort before the turns that follow them."""
+    if include_rolled_up:
+        result = _read(db().table("koedy_ancient_history").select("*").eq("user_id", user_id).order("id"), "get_ancient_history")
+        return sorted(result.data or [], key=ah_turn_bounds)
+
+    def load():
+        result = _read(db().table("koedy_ancient_history").select("*").eq("user_id", user_id).eq("rolled_up", False).order("id"), "get_ancient_history")
+        return sorted(result.data or [], key=ah_turn_bounds)
+    return cached(f"ah:{user_id}", load)
 
-    # Reverse to chronological order
-    return list(reversed(result.data))
+def get_recent_ah(user_id: str, limit: int = 4) -> List[Dict[str, Any]]:
+    """Get the user's most recent live ancient history entries for overlap prevention."""
+    entries = get_ancient_history(user_id)
+    return entries[-limit:] if limit else []
 
-def add_ancient_history_entry(user_id: str, turn_range: str, content: str):
-    db().table("koedy_ancient_history").insert({
+def add_ancient_history_entry(user_id: str, turn_range: str, content: str, level: int = 0) -> int:
+    result = _write(db().table("koedy_ancient_history").insert({
         "user_id": user_id,
         "turn_range": turn_range,
-        "content": content
-    }).execute()
+        "content": content,
+        "level": level,
+        "token_count": count_tokens(content)
+    }), "add_ancient_history_entry")
+    invalidate(f"ah:{user_id}")
+    return result.data[0]["id"] if result.data else 0
+
+def mark_ah_rolled_up(user_id: str, ids: List[int]):
+    _write(db().table("koedy_ancient_history").update({"rolled_up": True}).eq("user_id", user_id).in_("id", ids), "mark_ah_rolled_up")
+    invalidate(f"ah:{user_id}")
 
 # === Extended History Functions ===
 
 def archive_messages(user_id: str, messages: List[Dict[str, Any]], summary_id: int):
-    for msg in messages:
-        db().table("koedy_extended_history").insert({
-            "user_id": user_id,
-            "summary_id": summary_id,
-            "role": msg["role"],
-            "content": msg["content"],
-            "thinking": msg.get("thinking"),
-            "timestamp": msg["timestamp"]
-        }).execute()
+    # Synchronous, not write-behind: the caller deletes the source messages right
+    # after, so the archive has to have landed first or the conversation is lost
+    _write(db().table("koedy_extended_history").insert([{
+        "user_id": user_id,
+        "summary_id": summary_id,
+        "message_id": msg.get("id"),
+        "role": msg["role"],
+        "content": msg["content"],
+        "timestamp": msg["timestamp"]
+    } for msg in messages]), "archive_messages")
 
-def search_extended_history(user_id: str, query: str, limit: int = 20) -> List[Dict[str, Any]]:
-    result = db().table("koedy_extended_history").select(
-        "id, role, content, thinking, timestamp, summary_id"
-    ).eq("user_id", user_id).or_(
-        f"content.ilike.%{query}%,thinking.ilike.%{query}%"
-    ).order("id", desc=True).limit(limit).execute()
+EXTENDED_COLUMNS = "id, message_id, role, content, timestamp, summary_id"
 
-    if not result.data:
+def _cold_thinking(row: Dict[str, Any]) -> str:
+    # Segments written before migrations/0009 hold the old compressed form
+    if row.get("thinking_z"):
+        return decompress_thinking(row["thinking_z"])
+    return row.get("thinking") or ""
+
+def search_extended_history(user_id: str, query: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """Newest matches on content or thinking first, from the hot table and then the cold tier."""
+    high_water = get_cold_store().high_water(user_id)
+    result = _read(db().table("koedy_extended_history").select(EXTENDED_COLUMNS).eq("user_id", user_id).ilike(
+        "content", f"%{query}%"
+    ).order("id", desc=True).limit(limit), "search_extended_history")
+    hits = {row["id"]: row for row in result.data or []}
+
+    # Only archived rows: thinking of live messages would otherwise crowd them out of the limit
+    thinking = _read(db().rpc("search_archived_thinking", {
+        "p_user_id": user_id,
+        "p_query": query,
+        "p_limit": limit
+    }), "search_extended_history")
+    hits.update({row["id"]: row for row in thinking.data or []})
+
+    # Rows at or below the high-water mark are already in a segment, pending deletion
+    rows = sorted((row for row in hits.values() if row["id"] > high_water), key=lambda r: r["id"], reverse=True)[:limit]
+    if len(rows) < limit and high_water:
+        rows += get_cold_store().search(user_id, query, limit - len(rows), thinking_of=_cold_thinking)
+
+    if not rows:
         return []
 
-    summary_ids = list(set(row["summary_id"] for row in result.data if row["summary_id"]))
+    summary_ids = list(set(row["summary_id"] for row in rows if row["summary_id"]))
     summaries = {}
     if summary_ids:
-        sum_result = db().table("koedy_summaries").select("id, turn_start, turn_end").in_("id", summary_ids).execute()
+        sum_result = _read(db().table("koedy_summaries").select("id, turn_start, turn_end").in_("id", summary_ids), "search_extended_history")
         if sum_result.data:
             summaries = {s["id"]: s for s in sum_result.data}
 
     return [{
         "id": row["id"],
+        "message_id": row["message_id"],
         "role": row["role"],
         "content": row["content"],
-        "thinking": row["thinking"],
         "timestamp": row["timestamp"],
         "turn_start": summaries.get(row["summary_id"], {}).get("turn_start"),
         "turn_end": summaries.get(row["summary_id"], {}).get("turn_end")
-    } for row in result.data]
+    } for row in rows]
+
+def get_extended_history(user_id: str, include_thinking: bool = False, page_size: int = 1000) -> List[Dict[str, Any]]:
+    """Every archived message, oldest first: the cold tier, then the hot table."""
+    rows = []
+    for row in get_cold_store().iter_rows(user_id):
+        thinking = _cold_thinking(row) or None
+        row.pop("thinking_z", None)
+        row.pop("thinking", None)
+        if include_thinking:
+            row["thinking"] = thinking
+        rows.append(row)
+
+    last_id = get_cold_store().high_water(user_id)
+    while True:
+        result = _read(db().table("koedy_extended_history").select(EXTENDED_COLUMNS).eq("user_id", user_id).gt(
+            "id", last_id
+        ).order("id").limit(page_size), "get_extended_history")
+        page = result.data or []
+        if include_thinking and page:
+            message_ids = [r["message_id"] for r in page if r["message_id"] is not None]
+            by_message = {}
+            if message_ids:
+                t = _read(db().table("koedy_thinking").select("message_id, thinking_text").eq("user_id", user_id).in_("message_id", message_ids), "get_extended_history")
+                by_message = {r["message_id"]: r["thinking_text"] for r in t.data or []}
+            t = _read(db().table("koedy_thinking").select("extended_id, thinking_text").eq("user_id", user_id).in_("extended_id", [r["id"] for r in page]), "get_extended_history")
+            by_extended = {r["extended_id"]: r["thinking_text"] for r in t.data or []}
+            for r in page:
+                r["thinking"] = by_message.get(r["message_id"]) or by_extended.get(r["id"])
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+        last_id = page[-1]["id"]
 
 # === Notes Functions ===
 
+def _row_to_note(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "type": row["note_type"],
+        "content": row["content"],
+        "token_count": row.get("token_count"),
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"]
+    }
+
 def get_note(user_id: str, note_type: str) -> Optional[Dict[str, Any]]:
-    result = db().table("koedy_notes").select("*").eq("user_id", user_id).eq("note_type", note_type).execute()
-    if result.data:
-        row = result.data[0]
-        return {
-            "id": row["id"],
-            "type": note_type,
-            "content": row["content"],
-            "created_at": row["created_at"],
-            "updated_at": row["updated_at"]
-        }
-    return None
+    result = _read(db().table("koedy_notes").select("*").eq("user_id", user_id).eq("note_type", note_type), "get_note")
+    return _row_to_note(result.data[0]) if result.data else None
 
 def set_note(user_id: str, note_type: str, content: str):
-    now = datetime.now().isoformat()
-    existing = get_note(user_id, note_type)
-    if existing:
-        db().table("koedy_notes").update({
-            "content": content,
-            "updated_at": now
-        }).eq("user_id", user_id).eq("note_type", note_type).execute()
-    else:
-        db().table("koedy_notes").insert({
-            "user_id": user_id,
-            "note_type": note_type,
-            "content": content,
-            "created_at": now,
-            "updated_at": now
-        }).execute()
+    # created_at is left to the column default, so an update keeps the original
+    _write(db().table("koedy_notes").upsert({
+        "user_id": user_id,
+        "note_type": note_type,
+        "content": content,
+        "token_count": count_tokens(content),
+        "updated_at": datetime.now().isoformat()
+    }, on_conflict="user_id,note_type"), "set_note")
+    invalidate(f"notes:{user_id}")
 
 def get_all_notes(user_id: str) -> Dict[str, Optional[Dict[str, Any]]]:
-    return {
-        "active": get_note(user_id, "active"),
-        "ongoing": get_note(user_id, "ongoing"),
-        "permanent": get_note(user_id, "permanent")
-    }
+    def load():
+        result = _read(db().table("koedy_notes").select("*").eq("user_id", user_id), "get_all_notes")
+        notes = {"active": None, "ongoing": None, "permanent": None}
+        for row in result.data or []:
+            notes[row["note_type"]] = _row_to_note(row)
+        return notes
+    return cached(f"notes:{user_id}", load)
 
 def clear_note(user_id: str, note_type: str) -> bool:
     if note_type == "permanent":
         return False
-    result = db().table("koedy_notes").delete().eq("user_id", user_id).eq("note_type", note_type).execute()
+    result = _write(db().table("koedy_notes").delete().eq("user_id", user_id).eq("note_type", note_type), "clear_note")
+    invalidate(f"notes:{user_id}")
     return bool(result.data)
 
 # === Metadata / Turn Counter Functions ===
 
-def get_turn_counter(user_id: str) -> int:
-    result = db().table("koedy_metadata").select("value").eq("key", f"turn_counter_{user_id}").execute()
+def _load_turn_counter(user_id: str) -> int:
+    result = _read(db().table("koedy_metadata").select("value").eq("key", f"turn_counter_{user_id}"), "_load_turn_counter")
     if result.data:
         return int(result.data[0]["value"])
     return 0
 
+def get_turn_counter(user_id: str) -> int:
+    return cached(f"turn:{user_id}", lambda: _load_turn_counter(user_id))
+
 def increment_turn_counter(user_id: str) -> int:
-    current = get_turn_counter(user_id)
-    new_val = current + 1
-    result = db().table("koedy_metadata").update({
-        "value": str(new_val)
-    }).eq("key", f"turn_counter_{user_id}").execute()
-    if not result.data:
-        db().table("koedy_metadata").insert({
-            "key": f"turn_counter_{user_id}",
-            "value": str(new_val)
-        }).execute()
-    return new_val
+    # Atomic in the DB (migrations/0003_atomic_rpcs.sql) — never read-modify-write
+    result = _write(db().rpc("increment_turn_counter", {"p_user_id": user_id}), "increment_turn_counter")
+    invalidate(f"turn:{user_id}")
+    return int(result.data)
 
 # === Token Cost Calc ===
 
-def log_token_usage(user_id: str, call_type: str, input_tokens: int, output_tokens: int, input_cost: float, output_cost: float, total_cost: float):
-    db().table("koedy_token_usage").insert({
+def log_token_usage(user_id: str, call_type: str, input_tokens: int, output_tokens: int, input_cost: float, output_cost: float, total_cost: float, model: Optional[str] = None, route: Optional[str] = None, estimated_input_tokens: Optional[int] = None):
+    get_write_queue().enqueue("koedy_token_usage", {
         "user_id": user_id,
         "call_type": call_type,
+        "model": model,
+        "route": route,
         "input_tokens": input_tokens,
         "output_tokens": output_tokens,
         "input_cost": input_cost,
         "output_cost": output_cost,
-        "total_cost": total_cost
-    }).execute()
+        "total_cost": total_cost,
+        "estimated_input_tokens": estimated_input_tokens,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    })
 
-def get_user_total_usage(user_id: str) -> Dict[str, Any]:
-    result = db().table("koedy_token_usage").select("*").eq("user_id", user_id).execute()
-    if not result.data:
-        return {"input_tokens": 0, "output_tokens": 0, "total_cost": 0.0}
+def _sum_usage(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "input_tokens": sum(r["input_tokens"] for r in rows),
+        "output_tokens": sum(r["output_tokens"] for r in rows),
+        "total_cost": sum(float(r["total_cost"]) for r in rows)
+    }
+
+def _report_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        **{k: row[k] for k in ("day", "user_id", "call_type", "model") if row.get(k) is not None},
+        "calls": int(row["calls"]),
+        "input_tokens": int(row["input_tokens"]),
+        "output_tokens": int(row["output_tokens"]),
+        "input_cost": float(row["input_cost"]),
+        "output_cost": float(row["output_cost"]),
+        "total_cost": float(row["total_cost"])
+    }
 
-    total_in = sum(r["input_tokens"] for r in result.data)
-    total_out = sum(r["output_tokens"] for r in result.data)
-    total_cost = sum(float(r["total_cost"]) for r in result.data)
+def get_usage_report(start: Optional[date] = None, end: Optional[date] = None, user_id: Optional[str] = None, group_by: Tuple[str, ...] = ()) -> List[Dict[str, Any]]:
+    """Calls, tokens and spend over [start, end] (UTC days, inclusive), from the daily rollups.
+
+    group_by is any of "day", "user_id", "call_type", "model"; with none, one totals row.
+    Covers landed usage only, not rows still in the write-behind queue.
+    """
+    result = _read(db().rpc("usage_report", {
+        "p_start": start.isoformat() if start else None,
+        "p_end": end.isoformat() if end else None,
+        "p_user_id": user_id,
+        "p_group_by": list(group_by)
+    }), "get_usage_report")
+    return [_report_row(row) for row in result.data or []]
+
+def get_user_total_usage(user_id: str) -> Dict[str, Any]:
+    def load():
+        # koedy_usage_daily is maintained by trigger (migrations/0004_usage_rollups.sql)
+        rows = get_usage_report(user_id=user_id)
+        return rows[0] if rows else {"input_tokens": 0, "output_tokens": 0, "total_cost": 0.0}
+
+    # Short TTL: this backs the spending check
+    stored = cached(f"usage:{user_id}", load, ttl=15)
+    # Usage rows still sitting in the write-behind queue count toward the limit too
+    pending = _sum_usage(get_write_queue().pending_rows(
+        "koedy_token_usage", lambda r: r["user_id"] == user_id
+    ))
 
     return {
-        "input_tokens": total_in,
-        "output_tokens": total_out,
-        "total_cost": round(total_cost, 4)
+        "input_tokens": stored["input_tokens"] + pending["input_tokens"],
+        "output_tokens": stored["output_tokens"] + pending["output_tokens"],
+        "total_cost": round(stored["total_cost"] + pending["total_cost"], 4)
     }
 
 # === Export Functions ===
 
 def export_all_data(user_id: str) -> Dict[str, Any]:
-    messages = get_messages(user_id)
-    sum_result = db().table("koedy_summaries").select("*").eq("user_id", user_id).order("id", desc=False).execute()
+    messages = get_messages(user_id, include_thinking=True)
+    sum_result = _read(db().table("koedy_summaries").select("*").eq("user_id", user_id).order("id", desc=False), "export_all_data")
     summaries = sum_result.data if sum_result.data else []
-    ancient = get_ancient_history(user_id)
+    ancient = get_ancient_history(user_id, include_rolled_up=True)
     return {
         "messages": messages,
         "summaries": summaries,
         "ancient_history": ancient,
+        "extended_history": get_extended_history(user_id, include_thinking=True),
         "notes": get_all_notes(user_id),
         "turn_counter": get_turn_counter(user_id),
         "exported_at": datetime.now().isoformat()
@@ -286,27 +631,21 @@ def export_all_data(user_id: str) -> Dict[str, Any]:
     
 # === Spending Locks ===
 def get_spending_limit(user_id: str) -> float:
-    result = db().table("koedy_metadata").select("value").eq("key", f"spending_limit_{user_id}").execute()
-    if result.data:
-        return float(result.data[0]["value"])
-    return 10.00  # default limit
+    def load():
+        result = _read(db().table("koedy_metadata").select("value").eq("key", f"spending_limit_{user_id}"), "get_spending_limit")
+        if result.data:
+            return float(result.data[0]["value"])
+        return 10.00  # default limit
+    return cached(f"limit:{user_id}", load)
 
 def set_spending_limit(user_id: str, limit: float):
-    result = db().table("koedy_metadata").update({
+    _write(db().table("koedy_metadata").upsert({
+        "key": f"spending_limit_{user_id}",
         "value": str(limit)
-    }).eq("key", f"spending_limit_{user_id}").execute()
-    if not result.data:
-        db().table("koedy_metadata").insert({
-            "key": f"spending_limit_{user_id}",
-            "value": str(limit)
-        }).execute()
+    }, on_conflict="key"), "set_spending_limit")
+    invalidate(f"limit:{user_id}")
 
 def decrement_turn_counter(user_id: str) -> int:
-    current = get_turn_counter(user_id)
-    if current > 0:
-        new_val = current - 1
-        db().table("koedy_metadata").update({
-            "value": str(new_val)
-        }).eq("key", f"turn_counter_{user_id}").execute()
-        return new_val
-    return 0
\ No newline at end of file
+    result = _write(db().rpc("decrement_turn_counter", {"p_user_id": user_id}), "decrement_turn_counter")
+    invalidate(f"turn:{user_id}")
+    return int(result.data)
\ No newline at end of file
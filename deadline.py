@@ -0,0 +1,61 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+
+class DeadlineExceeded(Exception):
+    """The turn ran out of time before (or while) calling a dependency."""
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+
+_current: ContextVar[Optional[Deadline]] = ContextVar("koedy_deadline", default=None)
+
+
+@contextmanager
+def turn_deadline(seconds: float):
+    """Bound every DB, HTTP and model call made inside the block by one shared deadline.
+
+    Nested deadlines can only shorten the budget, never extend it.
+    """
+    outer = _current.get()
+    deadline = Deadline(seconds)
+    if outer and outer.expires_at < deadline.expires_at:
+        deadline = outer
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current.get()
+
+
+def time_budget(cap: float) -> float:
+    """Timeout for the next call: `cap`, shortened to whatever is left of the turn deadline."""
+    deadline = _current.get()
+    if deadline is None:
+        return cap
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        raise DeadlineExceeded("turn deadline exceeded")
+    return min(cap, remaining)
+
+
+def backoff(attempt: int, base: float = 0.1, cap: float = 2.0) -> float:
+    """Full-jitter exponential backoff, clipped so it never sleeps past the deadline."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    deadline = _current.get()
+    if deadline is not None:
+        delay = min(delay, deadline.remaining())
+    return delay
@@ -0,0 +1,681 @@
+"""Concurrent-session load test for app.py.
+
+Starts one headless Streamlit server for the real app.py, with fakes for
+Supabase, Anthropic and page fetches (each with configurable latency), and
+drives N concurrent websocket clients against it, the way N browser tabs
+would hit one worker. Each session sends messages and sometimes resends,
+deletes, searches or exports. A send only counts as a success if a new
+assistant reply was stored. For each concurrency level it reports
+throughput, p50/p95/p99 latency and failures per action, and the server's
+RSS growth per session next to its session_state.bytes gauge.
+
+    python loadtest.py --levels 1,5,10,25 --actions 20
+    python loadtest.py --levels 10 --model-latency 4 --db-latency-ms 40 --seed-messages 95
+
+Needs the app's requirements installed (Streamlit's server needs uvicorn and
+websockets, which the clients use too); no network or secrets are used.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+from urllib.request import urlopen
+
+import websockets
+from streamlit.proto.Alert_pb2 import Alert
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+ROOT = Path(__file__).parent
+SERVER_START_TIMEOUT = 60
+# One rerun, including a model call and any rollover it triggers
+ACTION_TIMEOUT = 600
+CHAT_PLACEHOLDER = "Hey there! Name's Koedy. What's on your mind?"
+
+# === Latency Model ===
+
+class Latency:
+    """Lognormal-ish delays around a median, so the tail looks like a real dependency."""
+
+    def __init__(self, median: float, spread: float = 0.5):
+        self.median = median
+        self.spread = spread
+
+    def sleep(self):
+        if self.median > 0:
+            time.sleep(self.median * random.lognormvariate(0, self.spread))
+
+# === Fake Supabase ===
+
+TABLE_DEFAULTS = {
+    "koedy_summaries": {"archived": False},
+    "koedy_ancient_history": {"level": 0, "rolled_up": False},
+}
+
+class FakeResult:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+class FakeQuery:
+    """Just enough of the postgrest builder for database.py. Re-executable, like the real one."""
+
+    def __init__(self, db: "FakeSupabase", table: str):
+        self._db = db
+        self._table = table
+        self._op = "select"
+        self._columns = "*"
+        self._count = None
+        self._payload: Any = None
+        self._on_conflict: Optional[str] = None
+        self._filters: List = []
+        self._negate_next = False
+        self._order: Optional[tuple] = None
+        self._limit: Optional[int] = None
+
+    def select(self, columns="*", count=None):
+        self._columns, self._count = columns, count
+        return self
+
+    def insert(self, payload):
+        self._op, self._payload = "insert", payload
+        return self
+
+    def upsert(self, payload, on_conflict=None):
+        self._op, self._payload, self._on_conflict = "upsert", payload, on_conflict
+        return self
+
+    def update(self, values):
+        self._op, self._payload = "update", values
+        return self
+
+    def delete(self):
+        self._op = "delete"
+        return self
+
+    @property
+    def not_(self):
+        self._negate_next = True
+        return self
+
+    def _filter(self, fn):
+        negate, self._negate_next = self._negate_next, False
+        self._filters.append((lambda row: not fn(row)) if negate else fn)
+        return self
+
+    def eq(self, col, value):
+        return self._filter(lambda row: row.get(col) == value)
+
+    def in_(self, col, values):
+        values = set(values)
+        return self._filter(lambda row: row.get(col) in values)
+
+    def is_(self, col, value):
+        return self._filter(lambda row: row.get(col) is None if value == "null" else row.get(col) is value)
+
+    def gt(self, col, value):
+        return self._filter(lambda row: row.get(col) is not None and row.get(col) > value)
+
+    def lte(self, col, value):
+        return self._filter(lambda row: row.get(col) is not None and row.get(col) <= value)
+
+    def ilike(self, col, pattern):
+        regex = re.compile("^" + ".*".join(re.escape(p) for p in pattern.split("%")) + "$", re.I | re.S)
+        return self._filter(lambda row: bool(regex.match(row.get(col) or "")))
+
+    def order(self, col, desc=False):
+        self._order = (col, desc)
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def execute(self):
+        self._db.latency.sleep()
+        with self._db.lock:
+            return getattr(self, f"_run_{self._op}")(self._db.tables.setdefault(self._table, []))
+
+    def _matches(self, rows):
+        return [row for row in rows if all(f(row) for f in self._filters)]
+
+    def _new_row(self, values):
+        row = {"id": next(self._db.ids), "created_at": time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime())}
+        row.update(TABLE_DEFAULTS.get(self._table, {}))
+        row.update(values)
+        return row
+
+    def _run_select(self, rows):
+        matched = self._matches(rows)
+        count = len(matched) if self._count else None
+        if self._order:
+            col, desc = self._order
+            matched = sorted(matched, key=lambda r: r.get(col) or 0, reverse=desc)
+        if self._limit is not None:
+            matched = matched[:self._limit]
+        if self._columns.strip() != "*":
+            cols = [c.strip() for c in self._columns.split(",")]
+            matched = [{c: row.get(c) for c in cols} for row in matched]
+        else:
+            matched = [dict(row) for row in matched]
+        return FakeResult(matched, count)
+
+    def _run_insert(self, rows):
+        payload = self._payload if isinstance(self._payload, list) else [self._payload]
+        inserted = [self._new_row(values) for values in payload]
+        rows.extend(inserted)
+        return FakeResult([dict(r) for r in inserted])
+
+    def _run_upsert(self, rows):
+        keys = [k.strip() for k in (self._on_conflict or "id").split(",")]
+        existing = next((r for r in rows if all(r.get(k) == self._payload.get(k) for k in keys)), None)
+        if existing:
+            existing.update(self._payload)
+            return FakeResult([dict(existing)])
+        return self._run_insert(rows)
+
+    def _run_update(self, rows):
+        matched = self._matches(rows)
+        for row in matched:
+            row.update(self._payload)
+        return FakeResult([dict(r) for r in matched])
+
+    def _run_delete(self, rows):
+        matched = self._matches(rows)
+        matched_ids = {id(r) for r in matched}
+        rows[:] = [r for r in rows if id(r) not in matched_ids]
+        return FakeResult([dict(r) for r in matched])
+
+class FakeRpc:
+    def __init__(self, db: "FakeSupabase", name: str, params: Dict[str, Any]):
+        self._db, self._name, self._params = db, name, params
+
+    def execute(self):
+        self._db.latency.sleep()
+        if self._name == "usage_report":
+            return self._usage_report()
+        if self._name == "search_archived_thinking":
+            return self._search_archived_thinking()
+        key = f"turn_counter_{self._params['p_user_id']}"
+        with self._db.lock:
+            rows = self._db.tables.setdefault("koedy_metadata", [])
+            row = next((r for r in rows if r["key"] == key), None)
+            if self._name == "increment_turn_counter":
+                if row is None:
+                    row = {"key": key, "value": "0"}
+                    rows.append(row)
+                row["value"] = str(int(row["value"]) + 1)
+            elif row is not None:
+                row["value"] = str(max(0, int(row["value"]) - 1))
+            return FakeResult(int(row["value"]) if row else 0)
+
+    def _usage_report(self):
+        # Aggregates raw usage directly; only the totals shape the app's spending check uses
+        user_id = self._params.get("p_user_id")
+        with self._db.lock:
+            rows = [r for r in self._db.tables.get("koedy_token_usage", []) if user_id is None or r["user_id"] == user_id]
+        if not rows:
+            return FakeResult([])
+        totals = {k: sum(r[k] for r in rows) for k in ("input_tokens", "output_tokens", "input_cost", "output_cost", "total_cost")}
+        return FakeResult([{"calls": len(rows), **totals}])
+
+    def _search_archived_thinking(self):
+        user_id, needle = self._params["p_user_id"], self._params["p_query"].lower()
+        with self._db.lock:
+            matched = [t for t in self._db.tables.get("koedy_thinking", [])
+                       if t["user_id"] == user_id and needle in (t.get("thinking_text") or "").lower()]
+            message_ids = {t["message_id"] for t in matched if t.get("message_id") is not None}
+            extended_ids = {t["extended_id"] for t in matched if t.get("extended_id") is not None}
+            rows = [r for r in self._db.tables.get("koedy_extended_history", [])
+                    if r["user_id"] == user_id and (r.get("message_id") in message_ids or r["id"] in extended_ids)]
+        rows = sorted(rows, key=lambda r: r["id"], reverse=True)[:self._params["p_limit"]]
+        return FakeResult([{c: r.get(c) for c in ("id", "message_id", "role", "content", "timestamp", "summary_id")} for r in rows])
+
+class FakeSupabase:
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.tables: Dict[str, List[Dict[str, Any]]] = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def rpc(self, name: str, params: Dict[str, Any]) -> FakeRpc:
+        return FakeRpc(self, name, params)
+
+# === Fake Anthropic ===
+
+REPLIES = [
+    "Ha, fair enough. What made you think of that?",
+    "That sounds like a lot to carry this week. How are you holding up?",
+    "Love that. Tell me more about how it went.",
+    "Okay, so the short version: yes, but watch the edge cases.",
+]
+
+class FakeMessages:
+    def __init__(self, latency: Latency, calls: List[float]):
+        self._latency = latency
+        self._calls = calls
+
+    def create(self, model: str, max_tokens: int, system=None, messages=(), thinking=None, timeout=None, **_):
+        start = time.monotonic()
+        self._latency.sleep()
+        self._calls.append(time.monotonic() - start)
+        prompt = json.dumps(messages) + (system if isinstance(system, str) else json.dumps(system or ""))
+        text = random.choice(REPLIES)
+        if "<summary>" in prompt:
+            # Combined memory update: answer in the tagged format it asks for
+            ids = dict.fromkeys(re.findall(r'<ah_entry id=\\"(\d+)\\">', prompt))
+            text = f"<summary>{text}</summary>" + "".join(f'<ah_entry id="{i}">{text}</ah_entry>' for i in ids)
+        elif random.random() < 0.1:
+            text += " [ACTIVE NOTE: user is load testing, keep it light]"
+        content = [SimpleNamespace(type="text", text=text)]
+        if thinking:
+            content.insert(0, SimpleNamespace(type="thinking", thinking="Considering the user's message. " * 40))
+        return SimpleNamespace(
+            model=model,
+            content=content,
+            usage=SimpleNamespace(input_tokens=len(prompt) // 4, output_tokens=len(text) // 4 + (400 if thinking else 0)),
+        )
+
+class FakeAnthropic:
+    latency = Latency(0)
+    calls: List[float] = []
+
+    def __init__(self, api_key=None, **_):
+        self.messages = FakeMessages(FakeAnthropic.latency, FakeAnthropic.calls)
+
+    def with_options(self, **_):
+        # Retries and timeouts don't apply to the fake
+        return self
+
+def fake_requests_get(latency: Latency):
+    def get(url, timeout=None, headers=None):
+        latency.sleep()
+        return SimpleNamespace(text=f"<html><body><p>Page at {url}</p></body></html>", raise_for_status=lambda: None)
+    return get
+
+# === Harness ===
+
+MESSAGES = [
+    "hey", "lol", "ok that makes sense",
+    "I've been thinking about switching jobs — how would you weigh stability against growth?",
+    "Can you help me plan a week of meals on a budget?",
+    "check this out https://example.com/article",
+    "what did we talk about last time regarding the move?",
+]
+
+def install_fakes(db_latency: Latency, model_latency: Latency, http_latency: Latency) -> FakeSupabase:
+    """Patch the client constructors the app uses. Must run before the app imports database.py."""
+    import anthropic
+    import requests
+    import supabase
+
+    fake_db = FakeSupabase(db_latency)
+    supabase.create_client = lambda url, key, options=None: fake_db
+    FakeAnthropic.latency = model_latency
+    anthropic.Anthropic = FakeAnthropic
+    requests.get = fake_requests_get(http_latency)
+    return fake_db
+
+def stage_workdir(users: List[str]) -> Path:
+    """Run from a scratch copy of the repo root so missing deploy-only assets can be stubbed.
+
+    Each user logs in with their own id as the access code.
+    """
+    workdir = Path(tempfile.mkdtemp(prefix="koedy-loadtest-"))
+    for path in ROOT.iterdir():
+        if path.name.startswith("."):
+            continue
+        (workdir / path.name).symlink_to(path)
+    (workdir / ".streamlit").mkdir()
+    (workdir / "cold_storage").mkdir()
+    shutil.copy(ROOT / ".streamlit" / "config.toml", workdir / ".streamlit" / "config.toml")
+    secrets = {
+        "ANTHROPIC_API_KEY": "fake",
+        "SUPABASE_URL": "http://fake",
+        "SUPABASE_KEY": "fake",
+        "KOEDY_PROMPT": "You are Koedy. " * 200,
+        "ACCESS_CODES": json.dumps({user_id: user_id for user_id in users}),
+        "COLD_STORAGE_DIR": str(workdir / "cold_storage"),
+        "EXPECTED_CONCURRENT_SESSIONS": len(users),
+    }
+    (workdir / ".streamlit" / "secrets.toml").write_text("".join(f"{k} = {json.dumps(v)}\n" for k, v in secrets.items()))
+    if not (workdir / "link_photo.png").exists():
+        (workdir / "link_photo.png").symlink_to(ROOT / "logo.png")
+    return workdir
+
+def seed_history(fake_db: FakeSupabase, user_id: str, count: int):
+    rows = fake_db.tables.setdefault("koedy_messages", [])
+    for i in range(count):
+        rows.append({
+            "id": next(fake_db.ids), "user_id": user_id,
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": random.choice(MESSAGES if i % 2 == 0 else REPLIES),
+            "timestamp": "Monday 12:00:00 2026-01-05",
+        })
+    fake_db.tables.setdefault("koedy_metadata", []).append({"key": f"turn_counter_{user_id}", "value": str(count // 2)})
+
+# === Server ===
+# One headless `streamlit run` of the real app, in its own process, with the
+# fakes installed before the app imports anything. A small side HTTP endpoint
+# exposes what only that process can see: its RSS, its gauges and the fake DB.
+
+def current_rss_kib() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        # Not Linux: peak rather than current, so growth reads as 0 once it plateaus
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def stats_handler(fake_db: FakeSupabase):
+    class StatsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/stats":
+                from metrics import gauges
+                body = {"rss_kib": current_rss_kib(), "gauges": gauges()}
+            elif url.path == "/latest":
+                user_id = parse_qs(url.query)["user"][0]
+                with fake_db.lock:
+                    rows = [r for r in fake_db.tables.get("koedy_messages", []) if r["user_id"] == user_id]
+                latest = max(rows, key=lambda r: r["id"], default=None)
+                body = {"id": latest["id"], "role": latest["role"]} if latest else None
+            else:
+                self.send_error(404)
+                return
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+    return StatsHandler
+
+def serve(workdir: str, port: int, stats_port: int, users: List[str], seed_messages: int, latencies: tuple):
+    """Entry point for the server process."""
+    from streamlit import config
+    from streamlit.web import bootstrap
+
+    os.chdir(workdir)
+    fake_db = install_fakes(*(Latency(seconds) for seconds in latencies))
+    for user_id in users:
+        seed_history(fake_db, user_id, seed_messages)
+    stats = ThreadingHTTPServer(("127.0.0.1", stats_port), stats_handler(fake_db))
+    threading.Thread(target=stats.serve_forever, daemon=True).start()
+
+    script = os.path.join(workdir, "app.py")
+    flags = {
+        "server_headless": True,
+        "server_port": port,
+        "server_address": "127.0.0.1",
+        "server_fileWatcherType": "none",
+        "server_runOnSave": False,
+        "browser_gatherUsageStats": False,
+    }
+    config._main_script_path = script
+    bootstrap.load_config_options(flag_options=flags)
+    bootstrap.run(script, False, [], flags)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def get_json(url: str) -> Any:
+    with urlopen(url, timeout=10) as response:
+        return json.loads(response.read())
+
+def wait_for_server(port: int, stats_port: int, server: multiprocessing.Process):
+    started = time.monotonic()
+    while time.monotonic() - started < SERVER_START_TIMEOUT:
+        if not server.is_alive():
+            raise SystemExit("the app server exited during startup")
+        try:
+            with urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=2):
+                pass
+            get_json(f"http://127.0.0.1:{stats_port}/stats")
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f"the app server didn't come up within {SERVER_START_TIMEOUT}s")
+
+# === Client ===
+# A browser session reduced to the websocket protocol: send a rerun with one
+# widget's new value, then read ForwardMsgs until the run finishes. Widget ids
+# (and the fragment each widget lives in) come from the deltas the server sent.
+
+class Session:
+    """One simulated browser tab. Each action is recorded as (action, seconds, ok)."""
+
+    def __init__(self, port: int, stats_port: int, user_id: str, actions: int):
+        self.port, self.stats_port, self.user_id, self.actions = port, stats_port, user_id, actions
+        self.timings: List[tuple] = []
+        self.errors: List[str] = []
+        self._ws = None
+        # (element type, label) -> (widget id, fragment id)
+        self._widgets: Dict[tuple, tuple] = {}
+
+    async def run(self, start: asyncio.Event):
+        """Load the page, then run the actions once `start` is set. Leaves the tab open; see close()."""
+        self._ws = await websockets.connect(
+            f"ws://127.0.0.1:{self.port}/_stcore/stream", subprotocols=["streamlit"], max_size=None
+        )
+        await self._timed("load", self._rerun())
+        await start.wait()
+        for _ in range(self.actions):
+            roll = random.random()
+            if roll < 0.70:
+                await self._timed("send", self._set("chat_input", CHAT_PLACEHOLDER, chat=random.choice(MESSAGES)))
+            elif roll < 0.80:
+                await self._timed("resend", self._set("button", "↻ Resend", trigger=True))
+            elif roll < 0.85:
+                await self._timed("delete", self._set("button", "✕ Delete", trigger=True))
+            elif roll < 0.95:
+                await self._timed("search", self._set("text_input", "Search", text=random.choice(["move", "job", "meal"])))
+            else:
+                await self._timed("export", self._set("button", "Export Data", trigger=True))
+
+    async def close(self):
+        if self._ws is not None:
+            await self._ws.close()
+
+    async def _set(self, kind: str, label: str, chat: Optional[str] = None, trigger: bool = False, text: Optional[str] = None) -> List[str]:
+        if (kind, label) not in self._widgets:
+            return [f"no {kind} {label!r} on the page"]
+        widget_id, fragment_id = self._widgets[(kind, label)]
+        state = WidgetState(id=widget_id)
+        if chat is not None:
+            state.chat_input_value.data = chat
+        elif trigger:
+            state.trigger_value = True
+        else:
+            state.string_value = text
+        return await self._rerun(state, fragment_id)
+
+    async def _rerun(self, widget: Optional[WidgetState] = None, fragment_id: str = "") -> List[str]:
+        """Send one rerun and wait for it (and any st.rerun() it triggers) to finish. Returns failures shown."""
+        msg = BackMsg()
+        msg.rerun_script.query_string = f"code={self.user_id}"
+        if widget is not None:
+            msg.rerun_script.widget_states.widgets.append(widget)
+        if fragment_id:
+            msg.rerun_script.fragment_id = fragment_id
+        await self._ws.send(msg.SerializeToString())
+
+        failures = []
+        while True:
+            fwd = ForwardMsg()
+            fwd.ParseFromString(await asyncio.wait_for(self._ws.recv(), ACTION_TIMEOUT))
+            kind = fwd.WhichOneof("type")
+            if kind == "new_session" and not fwd.new_session.fragment_ids_this_run:
+                # A full run re-sends every element; a fragment run only its own
+                self._widgets = {}
+            elif kind == "delta" and fwd.delta.WhichOneof("type") == "new_element":
+                failures += self._note_element(fwd.delta.new_element, fwd.delta.fragment_id)
+            elif kind == "script_finished":
+                if fwd.script_finished == ForwardMsg.FINISHED_WITH_COMPILE_ERROR:
+                    return failures + ["script failed to compile"]
+                if fwd.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    return failures
+
+    def _note_element(self, element, fragment_id: str) -> List[str]:
+        kind = element.WhichOneof("type")
+        if kind in ("button", "download_button", "text_input"):
+            widget = getattr(element, kind)
+            self._widgets[(kind, widget.label)] = (widget.id, fragment_id)
+        elif kind == "chat_input" and not element.chat_input.disabled:
+            self._widgets[(kind, element.chat_input.placeholder)] = (element.chat_input.id, fragment_id)
+        elif kind == "alert" and element.alert.format in (Alert.ERROR, Alert.WARNING):
+            # The app reports most failures as a warning and carries on, not as an exception
+            return [element.alert.body]
+        elif kind == "exception":
+            return [f"{element.exception.type}: {element.exception.message}"]
+        return []
+
+    async def _latest_message(self) -> Optional[Dict[str, Any]]:
+        url = f"http://127.0.0.1:{self.stats_port}/latest?user={self.user_id}"
+        return await asyncio.get_running_loop().run_in_executor(None, get_json, url)
+
+    async def _timed(self, action: str, run):
+        # A failed action still took that long for the user, so it stays in the latency samples
+        before = await self._latest_message() if action in ("send", "resend") else None
+        start = time.monotonic()
+        try:
+            failures = await run
+        except Exception as e:
+            failures = [repr(e)]
+        elapsed = time.monotonic() - start
+        if action in ("send", "resend") and not failures:
+            after = await self._latest_message()
+            if after is None or after["role"] != "assistant" or (before is not None and after["id"] <= before["id"]):
+                failures = ["no assistant reply stored"]
+        self.timings.append((action, elapsed, not failures))
+        self.errors.extend(f"{action}: {f}" for f in failures)
+
+def percentile(samples: List[float], pct: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))] if samples else float("nan")
+
+async def run_level(port: int, stats_port: int, users: List[str], actions: int) -> Dict[str, Any]:
+    stats_url = f"http://127.0.0.1:{stats_port}/stats"
+    before = get_json(stats_url)
+    sessions = [Session(port, stats_port, user_id, actions) for user_id in users]
+
+    # Every session loads first; actions start together once they all have
+    start = asyncio.Event()
+    tasks = [asyncio.create_task(s.run(start)) for s in sessions]
+    while sum(1 for s in sessions if s.timings) < len(sessions) and not any(t.done() for t in tasks):
+        await asyncio.sleep(0.05)
+    loaded = get_json(stats_url)
+    started = time.monotonic()
+    start.set()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.monotonic() - started
+    # Measured while every tab is still open, before the server can release any session
+    after = get_json(stats_url)
+    await asyncio.gather(*(s.close() for s in sessions), return_exceptions=True)
+
+    samples: Dict[str, List[float]] = {}
+    failed: Dict[str, int] = {}
+    errors: List[str] = [f"session: {r!r}" for r in results if isinstance(r, Exception)]
+    for s in sessions:
+        for action, seconds, ok in s.timings:
+            samples.setdefault(action, []).append(seconds)
+            failed[action] = failed.get(action, 0) + (not ok)
+        errors.extend(s.errors)
+
+    n = len(sessions)
+    attempted = sum(len(v) for k, v in samples.items() if k != "load")
+    peak = max(loaded["rss_kib"], after["rss_kib"])
+    return {
+        "concurrency": n,
+        "elapsed_s": round(elapsed, 2),
+        # Failed actions count too; see failed_actions for how many of these didn't succeed
+        "throughput_actions_per_s": round(attempted / elapsed, 2) if elapsed else 0,
+        "failed_actions": sum(v for k, v in failed.items() if k != "load"),
+        "latency_s": {action: {
+            "n": len(values),
+            "failed": failed[action],
+            "p50": round(percentile(values, 50), 3),
+            "p95": round(percentile(values, 95), 3),
+            "p99": round(percentile(values, 99), 3),
+        } for action, values in sorted(samples.items())},
+        # From the server process: growth over this level (negative if the previous level's
+        # sessions were released meanwhile), and the app's own session-state gauge
+        "rss_growth_kib_per_session": int((peak - before["rss_kib"]) / n),
+        "session_state_bytes_per_session": int(after["gauges"].get("session_state.bytes", 0) / max(1, after["gauges"].get("session_state.sessions", 0))),
+        "server_rss_kib": after["rss_kib"],
+        "errors": len(errors),
+        "sample_errors": errors[:5],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for app.py")
+    parser.add_argument("--levels", default="1,5,10", help="comma-separated session counts")
+    parser.add_argument("--actions", type=int, default=15, help="actions per session after the first load")
+    parser.add_argument("--seed-messages", type=int, default=20, help="history each user starts with (95+ exercises rollover)")
+    parser.add_argument("--db-latency-ms", type=float, default=25)
+    parser.add_argument("--model-latency", type=float, default=2.0, help="median seconds per model call")
+    parser.add_argument("--http-latency-ms", type=float, default=150)
+    parser.add_argument("--json", action="store_true", help="print raw JSON instead of a table")
+    args = parser.parse_args()
+
+    levels = [int(n) for n in args.levels.split(",")]
+    # Fresh users per level, so each starts from the same seeded history
+    users = [[f"load-{level}-{i}" for i in range(n)] for level, n in enumerate(levels)]
+    all_users = ["load-warmup"] + [u for level in users for u in level]
+    workdir = stage_workdir(all_users)
+    port, stats_port = free_port(), free_port()
+    latencies = (args.db_latency_ms / 1000, args.model_latency, args.http_latency_ms / 1000)
+    # spawn, not fork: the server must import the app (after its fakes) from scratch
+    server = multiprocessing.get_context("spawn").Process(
+        target=serve, args=(str(workdir), port, stats_port, all_users, args.seed_messages, latencies), daemon=True
+    )
+    server.start()
+    try:
+        wait_for_server(port, stats_port, server)
+        # The app's modules and shared resources load on the first run; keep that out of level 1
+        asyncio.run(run_level(port, stats_port, ["load-warmup"], 3))
+        results = []
+        for level_users in users:
+            result = asyncio.run(run_level(port, stats_port, level_users, args.actions))
+            results.append(result)
+            if not args.json:
+                print(f"\n== {result['concurrency']} concurrent sessions: {result['throughput_actions_per_s']} actions/s over {result['elapsed_s']}s "
+                      f"({result['failed_actions']} failed), {result['session_state_bytes_per_session']} B state/session, "
+                      f"{result['rss_growth_kib_per_session']} KiB RSS growth/session ({result['server_rss_kib']} KiB server), {result['errors']} errors")
+                for action, stats in result["latency_s"].items():
+                    print(f"   {action:<7} n={stats['n']:<4} failed={stats['failed']:<3} p50={stats['p50']:<7} p95={stats['p95']:<7} p99={stats['p99']}")
+                for err in result["sample_errors"]:
+                    print(f"   ! {err}")
+        if args.json:
+            print(json.dumps(results, indent=2))
+    finally:
+        server.terminate()
+        server.join(10)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
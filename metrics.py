@@ -0,0 +1,101 @@
+import json
+import logging
+import random
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyRecorder:
+    """Per-operation latency samples (bounded reservoir) for p50/p95/p99 reporting."""
+
+    def __init__(self, reservoir_size: int = 1024):
+        self._size = reservoir_size
+        self._samples: Dict[str, List[float]] = {}
+        self._counts: Dict[str, int] = {}
+        self._errors: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, op: str, seconds: float, error: bool = False):
+        with self._lock:
+            n = self._counts.get(op, 0) + 1
+            self._counts[op] = n
+            if error:
+                self._errors[op] = self._errors.get(op, 0) + 1
+            samples = self._samples.setdefault(op, [])
+            if len(samples) < self._size:
+                samples.append(seconds)
+            else:
+                # Reservoir sampling keeps a uniform sample of everything seen
+                slot = random.randrange(n)
+                if slot < self._size:
+                    samples[slot] = seconds
+
+    def percentile(self, op: str, pct: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(op, []))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+    def count(self, op: str) -> int:
+        with self._lock:
+            return self._counts.get(op, 0)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            ops = list(self._samples)
+            counts = dict(self._counts)
+            errors = dict(self._errors)
+        return {op: {
+            "count": counts.get(op, 0),
+            "errors": errors.get(op, 0),
+            "p50": self.percentile(op, 50),
+            "p95": self.percentile(op, 95),
+            "p99": self.percentile(op, 99),
+        } for op in ops}
+
+
+# Process-wide: one recorder for every dependency call
+latency = LatencyRecorder()
+
+# Point-in-time values, computed when read
+_gauges: Dict[str, Callable[[], float]] = {}
+
+
+def register_gauge(name: str, fn: Callable[[], float]):
+    _gauges[name] = fn
+
+
+def gauges() -> Dict[str, float]:
+    return {name: fn() for name, fn in _gauges.items()}
+
+
+class MetricsReporter:
+    """Logs the process's latency series and gauges as one JSON line every `interval` seconds, from a daemon thread."""
+
+    def __init__(self, interval: float = 60.0):
+        self._interval = interval
+        self._stop = threading.Event()
+        # Nothing configures logging in the app; make sure these lines go somewhere
+        if not logging.getLogger().handlers and not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+        self._thread = threading.Thread(target=self._run, name="koedy-metrics", daemon=True)
+        self._thread.start()
+
+    def report(self) -> Dict[str, Any]:
+        return {"latency": latency.snapshot(), "gauges": gauges()}
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                logger.info("metrics %s", json.dumps(self.report(), sort_keys=True))
+            except Exception:
+                logger.exception("metrics report failed")
+
+    def stop(self):
+        self._stop.set()
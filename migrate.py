@@ -0,0 +1,188 @@
+"""Apply the versioned SQL in migrations/ and check that database.py's queries are indexed.
+
+    python migrate.py            apply pending migrations (needs DATABASE_URL and psycopg)
+    python migrate.py --status   list applied / pending migrations
+    python migrate.py --check    flag queries in database.py with no supporting index (no DB needed)
+
+DATABASE_URL is the Postgres connection string from Supabase
+(Project Settings → Database), read from the environment or .streamlit/secrets.toml.
+"""
+import argparse
+import ast
+import os
+import re
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional
+
+ROOT = Path(__file__).parent
+MIGRATIONS_DIR = ROOT / "migrations"
+
+# === Runner ===
+
+def migration_files() -> List[Path]:
+    return sorted(MIGRATIONS_DIR.glob("[0-9][0-9][0-9][0-9]_*.sql"))
+
+def database_url() -> str:
+    url = os.environ.get("DATABASE_URL")
+    if not url:
+        secrets = ROOT / ".streamlit" / "secrets.toml"
+        if secrets.exists():
+            import tomllib
+            url = tomllib.loads(secrets.read_text()).get("DATABASE_URL")
+    if not url:
+        sys.exit("DATABASE_URL is not set (environment or .streamlit/secrets.toml)")
+    return url
+
+def connect():
+    try:
+        import psycopg
+    except ImportError:
+        sys.exit("The migration runner needs psycopg: pip install 'psycopg[binary]'")
+    return psycopg.connect(database_url())
+
+def applied_versions(conn) -> Dict[str, str]:
+    with conn.cursor() as cur:
+        cur.execute("""
+            create table if not exists schema_migrations (
+                version text primary key,
+                name text not null,
+                applied_at timestamptz not null default now()
+            )
+        """)
+        cur.execute("select version, name from schema_migrations")
+        return dict(cur.fetchall())
+
+def apply_pending():
+    with connect() as conn:
+        applied = applied_versions(conn)
+        conn.commit()
+        for path in migration_files():
+            version = path.name.split("_", 1)[0]
+            if version in applied:
+                continue
+            print(f"applying {path.name}")
+            # Each file runs in its own transaction; a failure leaves it unapplied
+            with conn.transaction():
+                with conn.cursor() as cur:
+                    cur.execute(path.read_text())
+                    cur.execute("insert into schema_migrations (version, name) values (%s, %s)", (version, path.name))
+        print("schema is up to date")
+
+def print_status():
+    with connect() as conn:
+        applied = applied_versions(conn)
+    for path in migration_files():
+        version = path.name.split("_", 1)[0]
+        print(f"{'applied' if version in applied else 'pending'}  {path.name}")
+
+# === Index Check ===
+
+CREATE_TABLE_RE = re.compile(r"create table if not exists (\w+) \((.*?)\n\);", re.S | re.I)
+CREATE_INDEX_RE = re.compile(
+    r"create (?:unique )?index (?:if not exists )?\w+ on (\w+)(?: using (\w+))? \(([^)]*)\)", re.I
+)
+
+def declared_indexes() -> Dict[str, List[List[str]]]:
+    """Column lists of every btree index, primary key and unique constraint, per table."""
+    indexes: Dict[str, List[List[str]]] = {}
+    sql = "\n".join(p.read_text() for p in migration_files())
+    sql = re.sub(r"--[^\n]*", "", sql)
+    for table, body in CREATE_TABLE_RE.findall(sql):
+        for line in body.split(","):
+            line = line.strip()
+            col = re.match(r"(\w+) .*\bprimary key\b", line, re.I)
+            if col:
+                indexes.setdefault(table, []).append([col.group(1)])
+            cols = re.match(r"(?:primary key|unique) \(([^)]*)\)", line, re.I)
+            if cols:
+                indexes.setdefault(table, []).append([c.strip() for c in cols.group(1).split(",")])
+    for table, method, cols in CREATE_INDEX_RE.findall(sql):
+        if method and method.lower() != "btree":
+            continue
+        indexes.setdefault(table, []).append([c.strip().split()[0] for c in cols.split(",")])
+    return indexes
+
+class Query:
+    def __init__(self, function: str, line: int, table: str):
+        self.function = function
+        self.line = line
+        self.table = table
+        self.kind = "select"
+        self.filters: List[str] = []
+        self.order: Optional[str] = None
+
+def _const(node) -> Optional[str]:
+    return node.value if isinstance(node, ast.Constant) and isinstance(node.value, str) else None
+
+def extract_queries(source: str) -> List[Query]:
+    """Every db().table("x")... chain in the source, with its equality filters and ordering."""
+    tree = ast.parse(source)
+    parents = {child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)}
+    queries = []
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "table"):
+            continue
+        table = _const(node.args[0]) if node.args else None
+        if table is None:
+            continue
+        func = node
+        while func in parents and not isinstance(func, ast.FunctionDef):
+            func = parents[func]
+        query = Query(getattr(func, "name", "<module>"), node.lineno, table)
+
+        current = node
+        while isinstance(parents.get(current), ast.Attribute) and isinstance(parents.get(parents[current]), ast.Call):
+            method = parents[current].attr
+            call = parents[parents[current]]
+            arg = _const(call.args[0]) if call.args else None
+            if method in ("insert", "upsert", "update", "delete"):
+                query.kind = method
+            elif method in ("eq", "in_", "is_") and arg:
+                query.filters.append(arg)
+            elif method == "order" and arg:
+                query.order = arg
+            current = call
+        queries.append(query)
+    return queries
+
+def supports(index: List[str], query: Query) -> bool:
+    """The index's leading columns are exactly the equality filters, followed by the ordering (if any)."""
+    filters = set(query.filters)
+    if set(index[:len(filters)]) != filters:
+        return False
+    if query.order is None:
+        return True
+    rest = index[len(filters):]
+    return bool(rest) and rest[0] == query.order
+
+def check_indexes(path: Path = ROOT / "database.py") -> int:
+    indexes = declared_indexes()
+    problems = 0
+    for query in extract_queries(path.read_text()):
+        if query.kind in ("insert", "upsert"):
+            continue
+        candidates = indexes.get(query.table, [])
+        if not query.filters:
+            print(f"{path.name}:{query.line} {query.function}: full scan of {query.table} (no filter)")
+            problems += 1
+        elif not any(supports(index, query) for index in candidates):
+            partial = any(index[0] in query.filters for index in candidates)
+            wanted = ", ".join(dict.fromkeys(query.filters + ([query.order] if query.order else [])))
+            kind = "only partly indexed" if partial else "no supporting index"
+            print(f"{path.name}:{query.line} {query.function}: {query.table} ({wanted}) {kind}")
+            problems += 1
+    print(f"{problems} query shape(s) without a supporting index")
+    return problems
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--status", action="store_true", help="list applied and pending migrations")
+    parser.add_argument("--check", action="store_true", help="flag database.py queries with no supporting index")
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(1 if check_indexes() else 0)
+    elif args.status:
+        print_status()
+    else:
+        apply_pending()
@@ -0,0 +1,65 @@
+"""Move inline thinking text into the koedy_thinking side table.
+
+Apply the schema migrations first (koedy_thinking and
+koedy_extended_history.message_id come from migrations/0001_initial_schema.sql):
+
+    python migrate.py
+    python migrate_thinking.py
+
+It also fills koedy_thinking.thinking_text (migrations/0006_thinking_search.sql)
+for rows that only have the old base64(zlib) thinking_z, which
+migrations/0009_drop_thinking_z.sql then drops; that migration won't apply
+until this has run, so re-run `python migrate.py` afterwards.
+
+The script is safe to re-run: rows whose thinking already has a side-table
+entry are only cleared, not copied twice. The old `thinking` columns are left
+in place (empty) so older app versions keep working during the rollout.
+"""
+from database import db, decompress_thinking
+
+BATCH_SIZE = 200
+
+def migrate_table(table: str, ref_column: str) -> int:
+    moved = 0
+    while True:
+        result = db().table(table).select("id, user_id, thinking").not_.is_("thinking", "null").order("id").limit(BATCH_SIZE).execute()
+        rows = result.data or []
+        if not rows:
+            return moved
+
+        ids = [row["id"] for row in rows]
+        existing = db().table("koedy_thinking").select(ref_column).in_(ref_column, ids).execute()
+        already_moved = {row[ref_column] for row in existing.data or []}
+
+        new_rows = [{
+            "user_id": row["user_id"],
+            "message_id": row["id"] if ref_column == "message_id" else None,
+            "extended_id": row["id"] if ref_column == "extended_id" else None,
+            "thinking_text": row["thinking"]
+        } for row in rows if row["thinking"] and row["id"] not in already_moved]
+        if new_rows:
+            db().table("koedy_thinking").insert(new_rows).execute()
+
+        db().table(table).update({"thinking": None}).in_("id", ids).execute()
+        moved += len(new_rows)
+        print(f"{table}: moved {moved} so far")
+
+def backfill_search_text() -> int:
+    # Nothing left to fill once 0009 has dropped thinking_z (thinking_text is then not null)
+    if not db().table("koedy_thinking").select("id").is_("thinking_text", "null").limit(1).execute().data:
+        return 0
+    filled = 0
+    while True:
+        result = db().table("koedy_thinking").select("id, thinking_z").is_("thinking_text", "null").order("id").limit(BATCH_SIZE).execute()
+        rows = result.data or []
+        if not rows:
+            return filled
+        for row in rows:
+            db().table("koedy_thinking").update({"thinking_text": decompress_thinking(row["thinking_z"])}).eq("id", row["id"]).execute()
+        filled += len(rows)
+        print(f"koedy_thinking: filled thinking_text for {filled} so far")
+
+if __name__ == "__main__":
+    print(f"koedy_messages: {migrate_table('koedy_messages', 'message_id')} rows moved")
+    print(f"koedy_extended_history: {migrate_table('koedy_extended_history', 'extended_id')} rows moved")
+    print(f"koedy_thinking: thinking_text filled for {backfill_search_text()} rows")
@@ -0,0 +1,82 @@
+-- Baseline schema for every table database.py touches.
+-- Written to be safe against an existing deployment: tables and columns are
+-- created only if missing, so this records the live shape rather than resetting it.
+
+create table if not exists koedy_messages (
+    id bigserial primary key,
+    user_id text not null,
+    role text not null,
+    content text not null,
+    thinking text,  -- legacy; thinking now lives in koedy_thinking
+    timestamp text,
+    created_at timestamptz not null default now()
+);
+
+create table if not exists koedy_thinking (
+    id bigserial primary key,
+    user_id text not null,
+    message_id bigint,
+    extended_id bigint,
+    thinking_z text not null,  -- base64(zlib(utf-8 thinking))
+    created_at timestamptz not null default now()
+);
+
+create table if not exists koedy_summaries (
+    id bigserial primary key,
+    user_id text not null,
+    turn_start integer not null,
+    turn_end integer not null,
+    summary_text text not null,
+    archived boolean not null default false,
+    created_at timestamptz not null default now()
+);
+
+create table if not exists koedy_ancient_history (
+    id bigserial primary key,
+    user_id text not null,
+    turn_range text not null,
+    content text not null,
+    created_at timestamptz not null default now()
+);
+alter table koedy_ancient_history add column if not exists level integer not null default 0;
+alter table koedy_ancient_history add column if not exists rolled_up boolean not null default false;
+
+create table if not exists koedy_extended_history (
+    id bigserial primary key,
+    user_id text not null,
+    summary_id bigint,
+    role text not null,
+    content text not null,
+    thinking text,  -- legacy; thinking now lives in koedy_thinking
+    timestamp text,
+    created_at timestamptz not null default now()
+);
+alter table koedy_extended_history add column if not exists message_id bigint;
+
+create table if not exists koedy_notes (
+    id bigserial primary key,
+    user_id text not null,
+    note_type text not null check (note_type in ('active', 'ongoing', 'permanent')),
+    content text not null,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+
+create table if not exists koedy_metadata (
+    key text primary key,
+    value text not null
+);
+
+create table if not exists koedy_token_usage (
+    id bigserial primary key,
+    user_id text not null,
+    call_type text not null,
+    input_tokens integer not null,
+    output_tokens integer not null,
+    input_cost numeric(12, 6) not null,
+    output_cost numeric(12, 6) not null,
+    total_cost numeric(12, 6) not null,
+    created_at timestamptz not null default now()
+);
+alter table koedy_token_usage add column if not exists model text;
+alter table koedy_token_usage add column if not exists route text;
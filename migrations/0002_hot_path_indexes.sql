@@ -0,0 +1,36 @@
+-- One index per query shape in database.py (`python migrate.py --check` verifies the match).
+
+-- get_messages / get_oldest_messages / get_message_count: user_id, ordered by id
+create index if not exists koedy_messages_user_id_idx on koedy_messages (user_id, id);
+
+-- get_thinking / _attach_thinking: per user, by source message or archived row
+create index if not exists koedy_thinking_user_message_idx on koedy_thinking (user_id, message_id);
+create index if not exists koedy_thinking_user_extended_idx on koedy_thinking (user_id, extended_id);
+-- delete_messages_by_ids drops thinking by message id alone
+create index if not exists koedy_thinking_message_idx on koedy_thinking (message_id);
+
+-- live summaries: (user_id, archived) ordered by id
+create index if not exists koedy_summaries_user_archived_idx on koedy_summaries (user_id, archived, id);
+-- get_total_turns_summarized / export: user_id ordered by id
+create index if not exists koedy_summaries_user_id_idx on koedy_summaries (user_id, id);
+
+-- live AH: (user_id, rolled_up) ordered by id
+create index if not exists koedy_ah_user_live_idx on koedy_ancient_history (user_id, rolled_up, id);
+create index if not exists koedy_ah_user_id_idx on koedy_ancient_history (user_id, id);
+
+-- search_extended_history: user_id + content ilike, newest first
+create extension if not exists pg_trgm;
+create index if not exists koedy_extended_user_id_idx on koedy_extended_history (user_id, id);
+create index if not exists koedy_extended_content_trgm_idx on koedy_extended_history using gin (content gin_trgm_ops);
+
+-- get_note / set_note upsert: at most one note of each type per user.
+-- Older code could leave duplicates; keep the most recently updated one (highest id on a tie).
+delete from koedy_notes a
+    using koedy_notes b
+    where a.user_id = b.user_id
+      and a.note_type = b.note_type
+      and (a.updated_at, a.id) < (b.updated_at, b.id);
+create unique index if not exists koedy_notes_user_type_key on koedy_notes (user_id, note_type);
+
+-- get_user_total_usage
+create index if not exists koedy_token_usage_user_idx on koedy_token_usage (user_id, created_at);
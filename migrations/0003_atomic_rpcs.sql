@@ -0,0 +1,25 @@
+-- Single-statement counter updates, so two tabs sending at once can't both read N and write N+1.
+
+create or replace function increment_turn_counter(p_user_id text)
+returns integer
+language sql
+as $$
+    insert into koedy_metadata (key, value)
+    values ('turn_counter_' || p_user_id, '1')
+    on conflict (key) do update
+        set value = (koedy_metadata.value::integer + 1)::text
+    returning value::integer;
+$$;
+
+create or replace function decrement_turn_counter(p_user_id text)
+returns integer
+language sql
+as $$
+    with updated as (
+        update koedy_metadata
+        set value = greatest(value::integer - 1, 0)::text
+        where key = 'turn_counter_' || p_user_id
+        returning value::integer as value
+    )
+    select coalesce((select value from updated), 0);
+$$;
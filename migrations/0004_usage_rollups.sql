@@ -0,0 +1,101 @@
+-- Daily per-user / per-call-type spend, kept current by a trigger on koedy_token_usage
+-- so reports and the spending check read a few rollup rows instead of every usage row.
+
+create table if not exists koedy_usage_daily (
+    user_id text not null,
+    day date not null,
+    call_type text not null,
+    model text not null default '',
+    calls integer not null default 0,
+    input_tokens bigint not null default 0,
+    output_tokens bigint not null default 0,
+    input_cost numeric(14, 6) not null default 0,
+    output_cost numeric(14, 6) not null default 0,
+    total_cost numeric(14, 6) not null default 0,
+    primary key (user_id, day, call_type, model)
+);
+
+-- Cross-user reports over a date range
+create index if not exists koedy_usage_daily_day_idx on koedy_usage_daily (day);
+
+-- Statement-level: the write-behind queue inserts usage in batches, so one
+-- upsert per (user, day, call_type, model) per batch rather than one per row.
+create or replace function koedy_usage_rollup()
+returns trigger
+language plpgsql
+as $$
+begin
+    insert into koedy_usage_daily as d
+        (user_id, day, call_type, model, calls, input_tokens, output_tokens, input_cost, output_cost, total_cost)
+    select user_id, (created_at at time zone 'utc')::date, call_type, coalesce(model, ''),
+           count(*), sum(input_tokens), sum(output_tokens), sum(input_cost), sum(output_cost), sum(total_cost)
+    from new_rows
+    group by 1, 2, 3, 4
+    on conflict (user_id, day, call_type, model) do update set
+        calls = d.calls + excluded.calls,
+        input_tokens = d.input_tokens + excluded.input_tokens,
+        output_tokens = d.output_tokens + excluded.output_tokens,
+        input_cost = d.input_cost + excluded.input_cost,
+        output_cost = d.output_cost + excluded.output_cost,
+        total_cost = d.total_cost + excluded.total_cost;
+    return null;
+end;
+$$;
+
+drop trigger if exists koedy_token_usage_rollup on koedy_token_usage;
+create trigger koedy_token_usage_rollup
+    after insert on koedy_token_usage
+    referencing new table as new_rows
+    for each statement execute function koedy_usage_rollup();
+
+-- Backfill from everything logged before the trigger existed
+truncate koedy_usage_daily;
+insert into koedy_usage_daily
+    (user_id, day, call_type, model, calls, input_tokens, output_tokens, input_cost, output_cost, total_cost)
+select user_id, (created_at at time zone 'utc')::date, call_type, coalesce(model, ''),
+       count(*), sum(input_tokens), sum(output_tokens), sum(input_cost), sum(output_cost), sum(total_cost)
+from koedy_token_usage
+group by 1, 2, 3, 4;
+
+-- Reporting: totals over [p_start, p_end] (either may be null for open-ended),
+-- optionally for one user, grouped by any of day / user_id / call_type / model.
+-- Columns not in p_group_by come back null.
+create or replace function usage_report(
+    p_start date default null,
+    p_end date default null,
+    p_user_id text default null,
+    p_group_by text[] default '{}'
+)
+returns table (
+    day date,
+    user_id text,
+    call_type text,
+    model text,
+    calls bigint,
+    input_tokens numeric,
+    output_tokens numeric,
+    input_cost numeric,
+    output_cost numeric,
+    total_cost numeric
+)
+language sql
+stable
+as $$
+    select
+        case when 'day' = any(p_group_by) then d.day end,
+        case when 'user_id' = any(p_group_by) then d.user_id end,
+        case when 'call_type' = any(p_group_by) then d.call_type end,
+        case when 'model' = any(p_group_by) then d.model end,
+        coalesce(sum(d.calls), 0),
+        coalesce(sum(d.input_tokens), 0),
+        coalesce(sum(d.output_tokens), 0),
+        coalesce(sum(d.input_cost), 0),
+        coalesce(sum(d.output_cost), 0),
+        coalesce(sum(d.total_cost), 0)
+    from koedy_usage_daily d
+    where (p_start is null or d.day >= p_start)
+      and (p_end is null or d.day <= p_end)
+      and (p_user_id is null or d.user_id = p_user_id)
+    group by 1, 2, 3, 4
+    order by 1, 2, 3, 4;
+$$;
@@ -0,0 +1,16 @@
+-- Token counts computed at write time (token_budget.count_tokens), so request
+-- estimates and the AH budget sum stored numbers instead of re-measuring text.
+
+alter table koedy_messages add column if not exists token_count integer;
+alter table koedy_summaries add column if not exists token_count integer;
+alter table koedy_ancient_history add column if not exists token_count integer;
+alter table koedy_notes add column if not exists token_count integer;
+
+-- Backfill with the same approximation the app uses (3.5 characters per token)
+update koedy_messages set token_count = ceil(length(content) / 3.5) where token_count is null;
+update koedy_summaries set token_count = ceil(length(summary_text) / 3.5) where token_count is null;
+update koedy_ancient_history set token_count = ceil(length(content) / 3.5) where token_count is null;
+update koedy_notes set token_count = ceil(length(content) / 3.5) where token_count is null;
+
+-- Pre-flight estimate next to the actual usage, for tracking estimator accuracy
+alter table koedy_token_usage add column if not exists estimated_input_tokens integer;
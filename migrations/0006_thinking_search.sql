@@ -0,0 +1,15 @@
+-- History search matches thinking as well as message text. thinking_z stays the
+-- compact form the app reads back; thinking_text is a plain copy that only backs
+-- search, compressed at rest by Postgres (lz4 TOAST) and trigram-indexed.
+-- Existing rows are filled in by `python migrate_thinking.py`.
+
+alter table koedy_thinking add column if not exists thinking_text text;
+alter table koedy_thinking alter column thinking_text set compression lz4;
+
+create extension if not exists pg_trgm;
+create index if not exists koedy_thinking_text_trgm_idx on koedy_thinking using gin (thinking_text gin_trgm_ops);
+-- search_extended_history: thinking matches per user, newest first
+create index if not exists koedy_thinking_user_id_idx on koedy_thinking (user_id, id);
+
+-- ...then mapped back to the archived rows they belong to
+create index if not exists koedy_extended_user_message_idx on koedy_extended_history (user_id, message_id);
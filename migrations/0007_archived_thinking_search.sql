@@ -0,0 +1,38 @@
+-- search_extended_history: archived rows whose thinking matches, newest first.
+-- The join happens here so thinking of live (not yet archived) messages can't
+-- fill the limit with hits that map to no archived row.
+
+create or replace function search_archived_thinking(
+    p_user_id text,
+    p_query text,
+    p_limit integer default 20
+)
+returns table (
+    id bigint,
+    message_id bigint,
+    role text,
+    content text,
+    "timestamp" text,
+    summary_id bigint
+)
+language sql
+stable
+as $$
+    select e.id, e.message_id, e.role, e.content, e.timestamp, e.summary_id
+    from koedy_extended_history e
+    where e.user_id = p_user_id
+      and e.id in (
+          -- keyed by source message (koedy_extended_user_message_idx)...
+          select x.id
+          from koedy_thinking t
+          join koedy_extended_history x on x.user_id = t.user_id and x.message_id = t.message_id
+          where t.user_id = p_user_id and t.thinking_text ilike '%' || p_query || '%'
+          union
+          -- ...or, pre-migration, by archive row
+          select t.extended_id
+          from koedy_thinking t
+          where t.user_id = p_user_id and t.extended_id is not null and t.thinking_text ilike '%' || p_query || '%'
+      )
+    order by e.id desc
+    limit p_limit;
+$$;
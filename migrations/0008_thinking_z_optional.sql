@@ -0,0 +1,5 @@
+-- New thinking rows are written as thinking_text only (lz4-compressed by TOAST,
+-- see 0006); thinking_z is kept, nullable, until migrate_thinking.py has filled
+-- thinking_text from it and 0009 drops it.
+
+alter table koedy_thinking alter column thinking_z drop not null;
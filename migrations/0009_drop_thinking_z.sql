@@ -0,0 +1,16 @@
+-- Store thinking once. Refuses to apply (and so stops `python migrate.py`) while
+-- any row still has only the old base64(zlib) form: run
+-- `python migrate_thinking.py` first, then `python migrate.py` again.
+
+do $$
+begin
+    if exists (
+        select 1 from information_schema.columns
+        where table_name = 'koedy_thinking' and column_name = 'thinking_z'
+    ) and exists (select 1 from koedy_thinking where thinking_text is null) then
+        raise exception 'koedy_thinking has rows without thinking_text; run python migrate_thinking.py first';
+    end if;
+end $$;
+
+alter table koedy_thinking drop column if exists thinking_z;
+alter table koedy_thinking alter column thinking_text set not null;
@@ -0,0 +1,71 @@
+from typing import Any, Dict, Optional
+
+# Dollars per token, (input, output)
+MODEL_PRICING = {
+    "claude-opus-4-6": (5.00 / 1_000_000, 25.00 / 1_000_000),
+    "claude-sonnet-4-5": (3.00 / 1_000_000, 15.00 / 1_000_000),
+    "claude-haiku-4-5": (1.00 / 1_000_000, 5.00 / 1_000_000),
+}
+
+# thinking_budget 0 = thinking off
+DEFAULT_ROUTES = {
+    "chat_light": {"model": "claude-opus-4-6", "max_tokens": 4000, "thinking_budget": 0},
+    "chat_standard": {"model": "claude-opus-4-6", "max_tokens": 16000, "thinking_budget": 10000},
+    "chat_heavy": {"model": "claude-opus-4-6", "max_tokens": 16000, "thinking_budget": 10000},
+    "summary": {"model": "claude-sonnet-4-5", "max_tokens": 5000, "thinking_budget": 3500},
+    "compression": {"model": "claude-sonnet-4-5", "max_tokens": 5000, "thinking_budget": 3000},
+    # Summary + any due AH compressions in one call
+    "memory_update": {"model": "claude-sonnet-4-5", "max_tokens": 8000, "thinking_budget": 5000},
+}
+
+# Prompt caching multipliers on the input rate
+CACHE_WRITE_MULTIPLIER = 1.25
+CACHE_READ_MULTIPLIER = 0.10
+
+DEFAULT_POLICY = {
+    # A chat turn is "light" only if it is short, has no attachment, no URL and no question
+    "light_max_chars": 60,
+    # Anything this long, or with an attachment or URL, is "heavy"
+    "heavy_min_chars": 1500,
+}
+
+
+class RoutingPolicy:
+    """Picks model, thinking budget and max_tokens per call from cheap request features.
+
+    Routes and thresholds can be overridden (e.g. from the MODEL_ROUTES secret):
+    {"routes": {"chat_light": {"model": "claude-sonnet-4-5"}}, "policy": {"light_max_chars": 40}}
+    """
+
+    def __init__(self, overrides: Optional[Dict[str, Any]] = None):
+        overrides = overrides or {}
+        self.routes = {name: dict(route) for name, route in DEFAULT_ROUTES.items()}
+        for name, route in overrides.get("routes", {}).items():
+            self.routes.setdefault(name, {}).update(route)
+        self.policy = {**DEFAULT_POLICY, **overrides.get("policy", {})}
+
+    def route_chat(self, text: str, has_attachment: bool = False, url_count: int = 0) -> str:
+        length = len(text.strip())
+        if has_attachment or url_count or length >= self.policy["heavy_min_chars"]:
+            return "chat_heavy"
+        if length <= self.policy["light_max_chars"] and "?" not in text:
+            return "chat_light"
+        return "chat_standard"
+
+    def request_kwargs(self, route_name: str) -> Dict[str, Any]:
+        """The model/max_tokens/thinking arguments for messages.create."""
+        route = self.routes[route_name]
+        kwargs = {"model": route["model"], "max_tokens": route["max_tokens"]}
+        if route.get("thinking_budget"):
+            kwargs["thinking"] = {"type": "enabled", "budget_tokens": route["thinking_budget"]}
+        return kwargs
+
+
+def price(model: str, input_tokens: int, output_tokens: int, cache_write_tokens: int = 0, cache_read_tokens: int = 0):
+    """Returns (input_cost, output_cost). Unknown models are priced as Opus so we never undercount.
+
+    input_tokens is the uncached input only, as reported in response.usage.
+    """
+    in_rate, out_rate = MODEL_PRICING.get(model, MODEL_PRICING["claude-opus-4-6"])
+    in_cost = (input_tokens + cache_write_tokens * CACHE_WRITE_MULTIPLIER + cache_read_tokens * CACHE_READ_MULTIPLIER) * in_rate
+    return in_cost, output_tokens * out_rate
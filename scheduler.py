@@ -0,0 +1,132 @@
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Set
+
+
+class Ticket:
+    __slots__ = ("user_id", "key", "fn", "seq", "future", "started", "done_at", "claimed")
+
+    def __init__(self, user_id: str, key: str, fn: Callable[[], Any], seq: int):
+        self.user_id = user_id
+        self.key = key
+        self.fn = fn
+        self.seq = seq
+        self.future: Future = Future()
+        self.started = False
+        self.done_at = 0.0
+        self.claimed = False
+
+
+class ModelCallScheduler:
+    """Process-wide gate for model calls.
+
+    - at most `max_concurrent` calls run at once across all sessions
+    - at most one call per user runs at a time (single-flight)
+    - waiting users are served round-robin, so one busy user can't starve the rest
+    - submitting a key that is already queued, running or finished-but-unclaimed
+      returns the existing ticket instead of paying for the call again
+    """
+
+    def __init__(self, max_concurrent: int = 4, result_ttl: float = 300.0):
+        self._max_concurrent = max_concurrent
+        self._result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="koedy-model")
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._queues: Dict[str, Deque[Ticket]] = {}
+        self._rotation: Deque[str] = deque()
+        self._active_users: Set[str] = set()
+        self._by_key: Dict[str, Ticket] = {}
+        self._running = 0
+
+    def submit(self, user_id: str, key: str, fn: Callable[[], Any]) -> Ticket:
+        with self._lock:
+            self._purge_expired()
+            existing = self._by_key.get(key)
+            if existing:
+                return existing
+            ticket = Ticket(user_id, key, fn, next(self._seq))
+            self._by_key[key] = ticket
+            if user_id not in self._queues:
+                self._queues[user_id] = deque()
+                self._rotation.append(user_id)
+            self._queues[user_id].append(ticket)
+            self._dispatch()
+            return ticket
+
+    def claim(self, ticket: Ticket) -> bool:
+        """Mark a finished result as consumed. Only the first caller gets True and should persist it."""
+        with self._lock:
+            if ticket.claimed or not ticket.future.done():
+                return False
+            ticket.claimed = True
+            if self._by_key.get(ticket.key) is ticket:
+                del self._by_key[ticket.key]
+            return True
+
+    def position(self, ticket: Ticket) -> int:
+        """How many calls are ahead of this ticket (0 once it is running)."""
+        with self._lock:
+            if ticket.started or ticket.future.done():
+                return 0
+            queued_ahead = sum(
+                1 for q in self._queues.values() for t in q if t.seq < ticket.seq
+            )
+            return queued_ahead + (self._running if self._running >= self._max_concurrent else 0)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "running": self._running,
+                "queued": sum(len(q) for q in self._queues.values()),
+                "max_concurrent": self._max_concurrent,
+            }
+
+    def _dispatch(self):
+        while self._running < self._max_concurrent and self._rotation:
+            for _ in range(len(self._rotation)):
+                user_id = self._rotation.popleft()
+                if user_id in self._active_users:
+                    self._rotation.append(user_id)
+                    continue
+                queue = self._queues[user_id]
+                ticket = queue.popleft()
+                if queue:
+                    self._rotation.append(user_id)
+                else:
+                    del self._queues[user_id]
+                self._start(ticket)
+                break
+            else:
+                # Everyone still waiting already has a call in flight
+                return
+
+    def _start(self, ticket: Ticket):
+        ticket.started = True
+        self._running += 1
+        self._active_users.add(ticket.user_id)
+        self._executor.submit(self._run, ticket)
+
+    def _run(self, ticket: Ticket):
+        try:
+            ticket.future.set_result(ticket.fn())
+        except BaseException as e:
+            ticket.future.set_exception(e)
+        finally:
+            with self._lock:
+                ticket.done_at = time.monotonic()
+                self._running -= 1
+                self._active_users.discard(ticket.user_id)
+                if ticket.future.exception() is not None and self._by_key.get(ticket.key) is ticket:
+                    # Don't pin failures — a retry should make a fresh call
+                    del self._by_key[ticket.key]
+                self._dispatch()
+
+    def _purge_expired(self):
+        cutoff = time.monotonic() - self._result_ttl
+        expired = [k for k, t in self._by_key.items() if t.done_at and t.done_at < cutoff]
+        for key in expired:
+            del self._by_key[key]
@@ -0,0 +1,168 @@
+import sys
+import threading
+import weakref
+from collections import OrderedDict, deque
+from typing import Any, Dict, Iterable, Iterator, Optional
+from metrics import register_gauge
+
+# Hard cap on what one browser session keeps for display. Older messages are
+# still in the DB (and history search); they just aren't held in memory.
+MAX_SESSION_BYTES = 1_000_000
+
+_RECORD_OVERHEAD = 120  # slotted object + small fields, roughly
+
+
+class MessageRecord:
+    __slots__ = ("id", "role", "content", "timestamp")
+
+    def __init__(self, role: str, content: str, timestamp: Optional[str] = None, id: Optional[int] = None):
+        self.id = id
+        self.role = sys.intern(role)
+        # Interned so several tabs of the same user share one copy of each message
+        self.content = sys.intern(content)
+        self.timestamp = timestamp
+
+    @property
+    def nbytes(self) -> int:
+        return _RECORD_OVERHEAD + sys.getsizeof(self.content) + (sys.getsizeof(self.timestamp) if self.timestamp else 0)
+
+
+_sessions: "weakref.WeakSet[SessionMessages]" = weakref.WeakSet()
+_memos: "weakref.WeakSet[SearchMemo]" = weakref.WeakSet()
+# Keyed by id(): dicts aren't hashable, so a WeakSet can't hold them
+_pending: "weakref.WeakValueDictionary[int, PendingAttachment]" = weakref.WeakValueDictionary()
+
+
+def _value_bytes(value: Any) -> int:
+    """Rough deep size of plain session-state values (dicts, lists, strings, numbers)."""
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_value_bytes(k) + _value_bytes(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_value_bytes(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class SessionMessages:
+    """Display history for one session: slotted records, no thinking, capped at `max_bytes`."""
+
+    def __init__(self, rows: Iterable[Dict[str, Any]] = (), max_bytes: int = MAX_SESSION_BYTES):
+        self._records: deque = deque()
+        self._max_bytes = max_bytes
+        self.nbytes = 0
+        self.dropped = 0
+        for row in rows:
+            self.append(row["role"], row["content"], row.get("timestamp"), row.get("id"))
+        _sessions.add(self)
+
+    def append(self, role: str, content: str, timestamp: Optional[str] = None, id: Optional[int] = None):
+        record = MessageRecord(role, content, timestamp, id)
+        self._records.append(record)
+        self.nbytes += record.nbytes
+        while self.nbytes > self._max_bytes and len(self._records) > 1:
+            self.nbytes -= self._records.popleft().nbytes
+            self.dropped += 1
+
+    def pop(self) -> MessageRecord:
+        record = self._records.pop()
+        self.nbytes -= record.nbytes
+        return record
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __iter__(self) -> Iterator[MessageRecord]:
+        return iter(self._records)
+
+    def __getitem__(self, index: int) -> MessageRecord:
+        return self._records[index]
+
+
+class SearchMemo:
+    """Per-session search results, newest `max_entries` queries kept."""
+
+    def __init__(self, max_entries: int):
+        self._max_entries = max_entries
+        self._results: "OrderedDict[str, list]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self.nbytes = 0
+        _memos.add(self)
+
+    def get(self, query: str) -> Optional[list]:
+        return self._results.get(query)
+
+    def put(self, query: str, results: list):
+        if query in self._results:
+            self.nbytes -= self._sizes.pop(query)
+            del self._results[query]
+        while len(self._results) >= self._max_entries:
+            oldest, _ = self._results.popitem(last=False)
+            self.nbytes -= self._sizes.pop(oldest)
+        self._results[query] = results
+        self._sizes[query] = _value_bytes(query) + _value_bytes(results)
+        self.nbytes += self._sizes[query]
+
+
+class PendingAttachment(dict):
+    """An attachment waiting for the next message. Image bytes stay in `attachments`; this holds the reference (or PDF text)."""
+
+    def __init__(self, **fields: Any):
+        super().__init__(**fields)
+        self.nbytes = _value_bytes(dict(self))
+        _pending[id(self)] = self
+
+
+class AttachmentStore:
+    """Process-wide, byte-bounded LRU for uploaded file bytes.
+
+    Sessions keep only a reference (the key), so the payload isn't copied into
+    every session's state and duplicate tabs share it.
+    """
+
+    def __init__(self, max_bytes: int = 64_000_000):
+        self._max_bytes = max_bytes
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self._items[key] = data
+            self.nbytes += len(data)
+            while self.nbytes > self._max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+
+attachments = AttachmentStore()
+
+
+def total_session_bytes() -> int:
+    """Bytes held across every live session in this process: display history, search
+    memos and pending attachments, plus the shared attachment store.
+
+    Per-session totals count interned content once per session, so this is an upper bound.
+    """
+    return (
+        sum(s.nbytes for s in list(_sessions))
+        + sum(m.nbytes for m in list(_memos))
+        + sum(p.nbytes for p in list(_pending.values()))
+        + attachments.nbytes
+    )
+
+
+def session_count() -> int:
+    return len(_sessions)
+
+
+register_gauge("session_state.bytes", total_session_bytes)
+register_gauge("session_state.sessions", session_count)
@@ -0,0 +1,169 @@
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "koedy:invalidate"
+
+
+class LocalBackend:
+    """In-process stand-in for the shared tier. Fine for a single worker and for tests."""
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[str, float]] = {}
+        self._subscribers: Dict[str, List[Callable[[str], None]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key: str, value: str, ttl: float):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            value = int(self._data.get(key, ("0", float("inf")))[0]) + 1
+            self._data[key] = (str(value), float("inf"))
+            return value
+
+    def publish(self, channel: str, message: str):
+        for callback in self._subscribers.get(channel, []):
+            callback(message)
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]):
+        self._subscribers.setdefault(channel, []).append(callback)
+
+
+class RedisBackend:
+    """Shared tier on any Redis-protocol server (Redis, Valkey, KeyDB, ...)."""
+
+    def __init__(self, url: str):
+        import redis  # optional dependency, only needed for multi-worker deploys
+
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+        self._pubsub = None
+
+    def get(self, key: str) -> Optional[str]:
+        return self._client.get(key)
+
+    def set(self, key: str, value: str, ttl: float):
+        self._client.set(key, value, px=int(ttl * 1000))
+
+    def delete(self, *keys: str):
+        if keys:
+            self._client.delete(*keys)
+
+    def incr(self, key: str) -> int:
+        return self._client.incr(key)
+
+    def publish(self, channel: str, message: str):
+        self._client.publish(channel, message)
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]):
+        if self._pubsub is None:
+            self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{channel: lambda msg: callback(msg["data"])})
+        self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+
+class SharedCache:
+    """Per-process L1 in front of a shared backend.
+
+    Values are JSON. Each key has a generation counter in the shared tier and
+    values are stored under `key@generation`. `invalidate` bumps the generation
+    and broadcasts the keys so every worker drops its L1 copy — no polling. A
+    loader that was already running when the key was invalidated writes its
+    (stale) result under the old generation, where nobody reads it. Backend
+    errors degrade to a cache miss rather than failing the request.
+    """
+
+    def __init__(self, backend, ttl: float = 300.0, l1_ttl: float = 30.0):
+        self._backend = backend
+        self._ttl = ttl
+        self._l1_ttl = l1_ttl
+        self._l1: Dict[str, Tuple[Any, float]] = {}
+        # Bumped on every local drop, so an in-flight load can't refill L1 with a stale value
+        self._l1_gen: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        backend.subscribe(INVALIDATION_CHANNEL, self._on_invalidate)
+
+    def get_or_load(self, key: str, loader: Callable[[], Any], ttl: Optional[float] = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            item = self._l1.get(key)
+            if item and item[1] > now:
+                return item[0]
+            l1_gen = self._l1_gen.get(key, 0)
+
+        value = None
+        slot = None
+        try:
+            # Read the generation before loading: a concurrent invalidate moves readers on to a new slot
+            slot = f"{key}@{self._backend.get(_gen_key(key)) or 0}"
+            raw = self._backend.get(slot)
+            if raw is not None:
+                value = json.loads(raw)
+        except Exception:
+            logger.warning("shared cache read failed for %s", key, exc_info=True)
+            raw = None
+
+        if raw is None:
+            value = loader()
+            if slot is not None:
+                try:
+                    self._backend.set(slot, json.dumps(value), ttl or self._ttl)
+                except Exception:
+                    logger.warning("shared cache write failed for %s", key, exc_info=True)
+
+        with self._lock:
+            if self._l1_gen.get(key, 0) == l1_gen:
+                self._l1[key] = (value, now + min(ttl or self._ttl, self._l1_ttl))
+        return value
+
+    def invalidate(self, *keys: str):
+        self._drop_local(keys)
+        try:
+            for key in keys:
+                self._backend.incr(_gen_key(key))
+            self._backend.publish(INVALIDATION_CHANNEL, json.dumps(list(keys)))
+        except Exception:
+            logger.warning("shared cache invalidation failed for %s", keys, exc_info=True)
+
+    def _on_invalidate(self, message: str):
+        self._drop_local(json.loads(message))
+
+    def _drop_local(self, keys):
+        with self._lock:
+            for key in keys:
+                self._l1.pop(key, None)
+                self._l1_gen[key] = self._l1_gen.get(key, 0) + 1
+
+
+def _gen_key(key: str) -> str:
+    return f"gen:{key}"
+
+
+def make_backend(redis_url: Optional[str] = None):
+    if redis_url:
+        try:
+            return RedisBackend(redis_url)
+        except ImportError:
+            logger.warning("REDIS_URL is set but the redis package is not installed; using a local cache")
+    return LocalBackend()
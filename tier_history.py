@@ -0,0 +1,101 @@
+"""Move extended history older than a threshold into the cold tier (cold_storage.py).
+
+    python tier_history.py                       every user in ACCESS_CODES, rows older than 30 days
+    python tier_history.py --days 90 --user alice
+
+Rows (with their thinking) are written to a new segment, and the
+segment and index are fsynced before anything is deleted from Postgres. If a
+run dies in between, the next run finds the rows at or below the index's
+high-water mark and finishes deleting them, so it is always safe to re-run.
+COLD_STORAGE_DIR must be set explicitly and point at an existing directory on
+the persistent volume every app worker mounts: the rows are deleted from
+Postgres, so the segments are then the only copy.
+"""
+import argparse
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+
+import streamlit as st
+
+from database import db, get_cold_store, EXTENDED_COLUMNS
+
+# Supabase's default PostgREST max-rows; one page becomes one segment
+SEGMENT_ROWS = 1000
+DELETE_BATCH = 200
+
+def _delete_hot(user_id: str, rows: List[Dict[str, Any]]):
+    for i in range(0, len(rows), DELETE_BATCH):
+        batch = rows[i:i + DELETE_BATCH]
+        ids = [r["id"] for r in batch]
+        message_ids = [r["message_id"] for r in batch if r["message_id"] is not None]
+        if message_ids:
+            db().table("koedy_thinking").delete().eq("user_id", user_id).in_("message_id", message_ids).execute()
+        db().table("koedy_thinking").delete().eq("user_id", user_id).in_("extended_id", ids).execute()
+        db().table("koedy_extended_history").delete().eq("user_id", user_id).in_("id", ids).execute()
+
+def _with_thinking(user_id: str, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    by_message, by_extended = {}, {}
+    for i in range(0, len(rows), DELETE_BATCH):
+        batch = rows[i:i + DELETE_BATCH]
+        message_ids = [r["message_id"] for r in batch if r["message_id"] is not None]
+        if message_ids:
+            result = db().table("koedy_thinking").select("message_id, thinking_text").eq("user_id", user_id).in_("message_id", message_ids).execute()
+            by_message.update({r["message_id"]: r["thinking_text"] for r in result.data or []})
+        result = db().table("koedy_thinking").select("extended_id, thinking_text").eq("user_id", user_id).in_("extended_id", [r["id"] for r in batch]).execute()
+        by_extended.update({r["extended_id"]: r["thinking_text"] for r in result.data or []})
+    for r in rows:
+        r["thinking"] = by_message.get(r["message_id"]) or by_extended.get(r["id"])
+    return rows
+
+def tier_user(user_id: str, cutoff: datetime) -> int:
+    store = get_cold_store()
+    high_water = store.high_water(user_id)
+
+    # Finish any deletes a previous run didn't get to
+    while high_water:
+        leftover = db().table("koedy_extended_history").select("id, message_id").eq("user_id", user_id).lte(
+            "id", high_water
+        ).order("id").limit(DELETE_BATCH).execute()
+        if not leftover.data:
+            break
+        _delete_hot(user_id, leftover.data)
+
+    moved = 0
+    while True:
+        result = db().table("koedy_extended_history").select(f"{EXTENDED_COLUMNS}, created_at").eq("user_id", user_id).gt(
+            "id", high_water
+        ).order("id").limit(SEGMENT_ROWS).execute()
+        rows = []
+        # Ids follow insert order, so stop at the first row that's still too new
+        for row in result.data or []:
+            if datetime.fromisoformat(row["created_at"]) >= cutoff:
+                break
+            rows.append(row)
+        if not rows:
+            return moved
+
+        segment = store.write_segment(user_id, _with_thinking(user_id, rows))
+        _delete_hot(user_id, rows)
+        moved += len(rows)
+        high_water = segment["last_id"]
+        print(f"{user_id}: {segment['file']} ({segment['rows']} rows, {segment['bytes']} bytes)")
+
+        if len(rows) < len(result.data):
+            return moved
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=int, default=30, help="tier rows archived more than this many days ago")
+    parser.add_argument("--user", action="append", help="only these users (default: every user in ACCESS_CODES)")
+    args = parser.parse_args()
+
+    cold_dir = st.secrets.get("COLD_STORAGE_DIR")
+    if not cold_dir or not os.path.isabs(cold_dir) or not os.path.isdir(cold_dir):
+        parser.error(f"COLD_STORAGE_DIR must be set to an existing absolute directory on persistent storage (got {cold_dir!r})")
+
+    cutoff = datetime.now(timezone.utc) - timedelta(days=args.days)
+    users = args.user or sorted(set(json.loads(st.secrets["ACCESS_CODES"]).values()))
+    for user_id in users:
+        print(f"{user_id}: {tier_user(user_id, cutoff)} rows moved to cold storage")
@@ -0,0 +1,96 @@
+import base64
+import math
+import threading
+from collections import deque
+from io import BytesIO
+from typing import Any, Dict, Optional, Union
+from metrics import register_gauge
+from routing import price
+
+# Local approximation of the Claude tokenizer (there's no offline one). Slightly
+# pessimistic for English prose; the per-model calibration below corrects it.
+CHARS_PER_TOKEN = 3.5
+
+# Images are resized to fit ~1.15 megapixels, about (width * height) / 750 tokens
+IMAGE_PIXELS_PER_TOKEN = 750
+IMAGE_MAX_TOKENS = 1600
+
+
+def count_tokens(text: Optional[str]) -> int:
+    return math.ceil(len(text or "") / CHARS_PER_TOKEN)
+
+
+def image_tokens(data: bytes) -> int:
+    try:
+        from PIL import Image
+        with Image.open(BytesIO(data)) as img:
+            width, height = img.size
+    except Exception:
+        return IMAGE_MAX_TOKENS
+    return min(IMAGE_MAX_TOKENS, math.ceil(width * height / IMAGE_PIXELS_PER_TOKEN))
+
+
+def content_tokens(content: Union[str, list]) -> int:
+    """Tokens for one message's content: a string or a list of text/image blocks."""
+    if isinstance(content, str):
+        return count_tokens(content)
+    total = 0
+    for block in content:
+        if block["type"] == "text":
+            total += count_tokens(block["text"])
+        elif block["type"] == "image":
+            total += image_tokens(base64.b64decode(block["source"]["data"]))
+    return total
+
+
+class CostEstimator:
+    """Prices a request before it is sent, calibrated against response.usage.
+
+    Input: local token count x a per-model correction (EMA of actual / estimated).
+    Output: EMA of actual output tokens per route, starting from a quarter of max_tokens.
+    """
+
+    def __init__(self, alpha: float = 0.2, history: int = 200):
+        self._alpha = alpha
+        self._input_ratio: Dict[str, float] = {}
+        self._output: Dict[str, float] = {}
+        self._errors: deque = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def input_tokens(self, model: str, raw_tokens: int) -> int:
+        with self._lock:
+            ratio = self._input_ratio.get(model, 1.0)
+        return math.ceil(raw_tokens * ratio)
+
+    def output_tokens(self, route: str, max_tokens: int) -> int:
+        with self._lock:
+            expected = self._output.get(route, max_tokens / 4)
+        return math.ceil(min(expected, max_tokens))
+
+    def cost(self, model: str, route: str, raw_input_tokens: int, max_tokens: int) -> float:
+        in_cost, out_cost = price(model, self.input_tokens(model, raw_input_tokens), self.output_tokens(route, max_tokens))
+        return in_cost + out_cost
+
+    def observe(self, model: str, route: str, raw_input_tokens: int, usage: Any) -> Dict[str, Any]:
+        """Fold one response's usage into the calibration. Returns the estimate-vs-actual record."""
+        actual = usage.input_tokens + (getattr(usage, "cache_creation_input_tokens", 0) or 0) + (getattr(usage, "cache_read_input_tokens", 0) or 0)
+        estimated = self.input_tokens(model, raw_input_tokens)
+        error = (estimated - actual) / actual if actual else 0.0
+        with self._lock:
+            if raw_input_tokens and actual:
+                ratio = self._input_ratio.get(model, 1.0)
+                self._input_ratio[model] = ratio + self._alpha * (actual / raw_input_tokens - ratio)
+            out = self._output.get(route)
+            self._output[route] = usage.output_tokens if out is None else out + self._alpha * (usage.output_tokens - out)
+            self._errors.append(abs(error))
+        return {"estimated_input_tokens": estimated, "actual_input_tokens": actual, "error": error}
+
+    def mean_abs_error(self) -> float:
+        with self._lock:
+            return sum(self._errors) / len(self._errors) if self._errors else 0.0
+
+
+# Process-wide, so calibration carries across sessions
+estimator = CostEstimator()
+
+register_gauge("estimate.input_mean_abs_error", estimator.mean_abs_error)
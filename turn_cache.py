@@ -0,0 +1,48 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+class TurnSnapshotCache:
+    """Fully assembled model requests, kept per user so a resend or retry can reuse them.
+
+    Holds at most `max_per_user` recent turns for each of the `max_users` most
+    recently active users; the least recently used user is evicted first.
+    """
+
+    def __init__(self, max_users: int = 256, max_per_user: int = 2):
+        self._max_users = max_users
+        self._max_per_user = max_per_user
+        self._lock = threading.Lock()
+        self._users: "OrderedDict[str, OrderedDict[str, Dict[str, Any]]]" = OrderedDict()
+
+    def put(self, user_id: str, snapshot: Dict[str, Any]):
+        snapshot["created_at"] = time.time()
+        with self._lock:
+            turns = self._users.pop(user_id, None) or OrderedDict()
+            turns.pop(snapshot["turn_key"], None)
+            turns[snapshot["turn_key"]] = snapshot
+            while len(turns) > self._max_per_user:
+                turns.popitem(last=False)
+            self._users[user_id] = turns
+            while len(self._users) > self._max_users:
+                self._users.popitem(last=False)
+
+    def latest(self, user_id: str, context_depth: Optional[int] = None, turn_key: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """The user's most recent snapshot, or None if it was built for another depth or turn."""
+        with self._lock:
+            turns = self._users.get(user_id)
+            if not turns:
+                return None
+            self._users.move_to_end(user_id)
+            snapshot = next(reversed(turns.values()))
+        if context_depth is not None and snapshot["context_depth"] != context_depth:
+            return None
+        if turn_key is not None and snapshot["turn_key"] != turn_key:
+            return None
+        return snapshot
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._users.pop(user_id, None)
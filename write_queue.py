@@ -0,0 +1,126 @@
+import atexit
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """Batches non-critical inserts and flushes them off the request path.
+
+    Rows are grouped per table and written with one bulk insert per batch,
+    either every `flush_interval` seconds or as soon as a table reaches
+    `max_batch` rows. Failed batches are retried with jittered backoff and
+    requeued if they still fail; `drain()` runs at process shutdown.
+    `on_flush(table, rows)` is called after each batch lands.
+    """
+
+    def __init__(
+        self,
+        insert_fn: Callable[[str, List[Dict[str, Any]]], None],
+        flush_interval: float = 2.0,
+        max_batch: int = 100,
+        max_retries: int = 4,
+        on_flush: Optional[Callable[[str, List[Dict[str, Any]]], None]] = None,
+    ):
+        self._insert_fn = insert_fn
+        self._flush_interval = flush_interval
+        self._max_batch = max_batch
+        self._max_retries = max_retries
+        self._on_flush = on_flush
+        self._pending: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._inflight: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="koedy-write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.drain)
+
+    def enqueue(self, table: str, row: Dict[str, Any]):
+        with self._lock:
+            if not self._stopped:
+                self._pending[table].append(row)
+                if len(self._pending[table]) >= self._max_batch:
+                    self._wake.set()
+                return
+        # Shutting down — nothing will flush later, so write through
+        self._insert_fn(table, [row])
+        if self._on_flush:
+            self._on_flush(table, [row])
+
+    def enqueue_many(self, table: str, rows: List[Dict[str, Any]]):
+        for row in rows:
+            self.enqueue(table, row)
+
+    def pending_rows(self, table: str, predicate: Optional[Callable[[Dict[str, Any]], bool]] = None) -> List[Dict[str, Any]]:
+        """Rows for `table` not yet confirmed written, including the batch being flushed.
+
+        A batch stays visible here until its insert returns, so a reader may briefly
+        count a row both here and in the table — never neither.
+        """
+        with self._lock:
+            rows = self._inflight[table] + self._pending[table]
+        return [r for r in rows if predicate is None or predicate(r)]
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batches = {t: rows for t, rows in self._pending.items() if rows}
+                self._pending = defaultdict(list)
+                for table, rows in batches.items():
+                    self._inflight[table].extend(rows)
+
+            for table, rows in batches.items():
+                for i in range(0, len(rows), self._max_batch):
+                    chunk = rows[i:i + self._max_batch]
+                    ok = self._insert_with_retry(table, chunk)
+                    # Hook runs before the rows leave pending_rows(), so readers never miss them
+                    if ok and self._on_flush:
+                        try:
+                            self._on_flush(table, chunk)
+                        except Exception:
+                            logger.exception("write-behind on_flush hook failed")
+                    chunk_ids = {id(r) for r in chunk}
+                    with self._lock:
+                        self._inflight[table] = [r for r in self._inflight[table] if id(r) not in chunk_ids]
+                        if not ok:
+                            # Keep the rows (and their order) for the next interval
+                            self._pending[table][:0] = chunk
+
+    def drain(self, timeout: float = 10.0):
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        self._wake.set()
+        self._thread.join(timeout)
+        self.flush()
+        with self._lock:
+            dropped = {t: len(rows) for t, rows in self._pending.items() if rows}
+        if dropped:
+            logger.error("write-behind queue drained with unwritten rows: %s", dropped)
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self._flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("write-behind flush failed")
+
+    def _insert_with_retry(self, table: str, rows: List[Dict[str, Any]]) -> bool:
+        for attempt in range(self._max_retries):
+            try:
+                self._insert_fn(table, rows)
+                return True
+            except Exception:
+                logger.warning("bulk insert into %s failed (attempt %d)", table, attempt + 1, exc_info=True)
+                time.sleep(min(5.0, 0.2 * 2 ** attempt) * random.uniform(0.5, 1.5))
+        return False